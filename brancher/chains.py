@@ -3,7 +3,12 @@ Chains
 ---------
 Module description
 """
-from chainer import ChainList
+import numpy as np
+import chainer
+import chainer.functions as F
+from chainer import Link, ChainList, Parameter
+
+from brancher.utilities import is_memoizing
 
 
 class EmptyChain(ChainList):
@@ -13,3 +18,99 @@ class EmptyChain(ChainList):
     def __init__(self):
         links = []
         super(EmptyChain, self).__init__(*links)
+
+
+class ParameterBuffer(Link):
+    """
+    Link that stores the parameters of many learnable deterministic variables in a single contiguous parameter, so that
+    an optimizer updates all of them with one vectorized update. The parameter is split in a single operation and the
+    pieces are reused by all the variables until the next update.
+
+    Parameters
+    ----------
+    arrays : list of np.ndarray
+        Initial values of the parameters.
+    """
+    def __init__(self, arrays):
+        super(ParameterBuffer, self).__init__()
+        self.shapes = [array.shape for array in arrays]
+        self.sections = [int(section) for section in np.cumsum([array.size for array in arrays])[:-1]]
+        with self.init_scope():
+            self.values = Parameter(np.concatenate([np.ravel(array) for array in arrays]).astype("float32"))
+        self._pieces = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_pieces"] = None
+        return state
+
+    def get_pieces(self):
+        """
+        It returns the list of parameters as chainer.Variables with their original shapes. With backprop enabled, the
+        same list is returned until the buffer is invalidated.
+        """
+        memoize = chainer.config.enable_backprop and is_memoizing()
+        if self._pieces is not None and memoize:
+            return self._pieces
+        pieces = F.split_axis(self.values, self.sections, axis=0) if self.sections else (self.values,)
+        pieces = [F.reshape(piece, shape) for piece, shape in zip(pieces, self.shapes)]
+        if memoize:
+            self._pieces = pieces
+        return pieces
+
+    def get_parameter(self, index):
+        """
+        It returns the parameter with the given index as a leaf chainer.Variable with its original shape. Its array and
+        its gradient are views of the buffer, so reading them or writing in them acts on the parameter that the
+        optimizer updates. After writing in the array, the buffer has to be invalidated.
+        """
+        start = self.sections[index - 1] if index > 0 else 0
+        end = self.sections[index] if index < len(self.sections) else self.values.size
+        grad = self.values.grad
+        return chainer.Variable(self.values.array[start:end].reshape(self.shapes[index]),
+                                grad=None if grad is None else grad[start:end].reshape(self.shapes[index]))
+
+    def invalidate(self):
+        """
+        It discards the pieces of the parameter. It has to be called after the parameter is updated.
+        """
+        self._pieces = None
+
+
+class ParameterView(object):
+    """
+    Link of a learnable deterministic variable whose parameter is stored in a ParameterBuffer. As chainer.links.Bias,
+    it adds the parameter to its input and the parameter is available as the attribute b. The result is memoized until
+    the buffer is updated, so that the value of the variable is computed once per iteration.
+
+    Parameters
+    ----------
+    buffer : brancher.chains.ParameterBuffer
+    index : int
+        Index of the parameter in the buffer.
+    """
+    def __init__(self, buffer, index):
+        self.buffer = buffer
+        self.index = index
+        self._memo = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_memo"] = None
+        return state
+
+    def __call__(self, x):
+        pieces = self.buffer.get_pieces()
+        if not is_memoizing():
+            return x + pieces[self.index]
+        if self._memo is None or self._memo[0] is not pieces or self._memo[1] is not x:
+            self._memo = (pieces, x, x + pieces[self.index])
+        return self._memo[2]
+
+    @property
+    def b(self):
+        """
+        The parameter of the variable, see ParameterBuffer.get_parameter. The value of the variable is computed from the
+        pieces of the buffer and not from this leaf.
+        """
+        return self.buffer.get_parameter(self.index)
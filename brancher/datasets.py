@@ -0,0 +1,131 @@
+"""
+Datasets
+---------
+Module description
+"""
+from abc import ABC, abstractmethod
+import os
+
+import numpy as np
+
+
+class Dataset(ABC):
+    """
+    Dataset is the abstract superclass of the out-of-core dataset backends. A backend only loads in memory the rows that
+    are requested, so that it can be used as the dataset of an EmpiricalVariable larger than the available memory.
+    """
+    @abstractmethod
+    def __len__(self):
+        pass
+
+    @abstractmethod
+    def get_rows(self, indices):
+        """
+        Abstract method. It returns the requested rows of the dataset.
+
+        Args:
+            indices: Iterable of Int. Indices of the rows along the first axis.
+
+        Returns:
+            np.ndarray. Array of shape (len(indices),) + row shape.
+        """
+        pass
+
+
+class MemoryMappedDataset(Dataset):
+    """
+    Dataset stored in a single .npy file or in a np.memmap. The rows are read from disk when requested. A dataset
+    opened from a path is pickled as its path, so the file is opened again instead of being copied.
+
+    Parameters
+    ----------
+    data : str or np.memmap
+        Path of the .npy file or memory-mapped array.
+    """
+    def __init__(self, data):
+        self.path = data if isinstance(data, str) else None
+        if isinstance(data, str):
+            data = np.load(data, mmap_mode="r")
+        self.data = data
+
+    def __getstate__(self):
+        if self.path is None:
+            return {"path": None, "data": self.data}
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"] if state["path"] is not None else state["data"])
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def get_rows(self, indices):
+        indices = np.asarray(indices, dtype=int)
+        order = np.argsort(indices)
+        rows = np.empty((len(indices),) + self.data.shape[1:], dtype=self.data.dtype)
+        rows[order] = self.data[indices[order]]
+        return rows
+
+
+class ShardedDataset(Dataset):
+    """
+    Dataset stored in a directory of .npy shards. The shards are concatenated along the first axis in alphabetical order
+    of their file names and the rows are read from disk when requested. It is pickled as the path of the directory.
+
+    Parameters
+    ----------
+    directory : str
+        Path of the directory containing the shards.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        file_names = sorted(name for name in os.listdir(directory) if name.endswith(".npy"))
+        if not file_names:
+            raise ValueError("The directory {} does not contain any .npy shard".format(directory))
+        self.shards = [np.load(os.path.join(directory, name), mmap_mode="r") for name in file_names]
+        if len({(shard.shape[1:], shard.dtype) for shard in self.shards}) > 1:
+            raise ValueError("All the shards in {} need to have the same row shape and dtype".format(directory))
+        self.offsets = np.cumsum([0] + [shard.shape[0] for shard in self.shards])
+
+    def __getstate__(self):
+        return {"directory": self.directory}
+
+    def __setstate__(self, state):
+        self.__init__(state["directory"])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def get_rows(self, indices):
+        indices = np.asarray(indices, dtype=int)
+        shard_indices = np.searchsorted(self.offsets, indices, side="right") - 1
+        first_shard = self.shards[0]
+        rows = np.empty((len(indices),) + first_shard.shape[1:], dtype=first_shard.dtype)
+        for shard_index in np.unique(shard_indices):
+            in_shard = shard_indices == shard_index
+            local_indices = indices[in_shard] - self.offsets[shard_index]
+            order = np.argsort(local_indices)
+            shard_rows = np.empty((len(local_indices),) + first_shard.shape[1:], dtype=first_shard.dtype)
+            shard_rows[order] = self.shards[shard_index][local_indices[order]]
+            rows[in_shard] = shard_rows
+        return rows
+
+
+def load_dataset(data):
+    """
+    It returns an out-of-core backend for paths and memory-mapped arrays and the input unchanged otherwise.
+
+    Args:
+        data: str, np.memmap or any dataset accepted by EmpiricalVariable. A path can point either to a .npy file or to
+        a directory of .npy shards.
+
+    Returns:
+        brancher.datasets.Dataset or the input.
+    """
+    if isinstance(data, str):
+        if os.path.isdir(data):
+            return ShardedDataset(data)
+        return MemoryMappedDataset(data)
+    elif isinstance(data, np.memmap):
+        return MemoryMappedDataset(data)
+    return data
@@ -4,16 +4,25 @@ Distributions
 Module description
 """
 from abc import ABC, abstractmethod
+import threading
 
 import chainer
 import chainer.functions as F
 import numpy as np
 from scipy.special import binom
 
+from brancher.datasets import Dataset
 from brancher.utilities import broadcast_and_squeeze
+from brancher.utilities import coerce_to_dtype
 from brancher.utilities import sum_data_dimensions
 from brancher.utilities import get_diagonal
-from brancher.utilities import broadcast_parent_values
+from brancher.utilities import get_one_hot
+from brancher.utilities import sample_categorical_indices
+from brancher.utilities import get_random_state
+from brancher.kernels import normal_log_density
+from brancher.kernels import log_normal_log_density
+from brancher.kernels import logit_normal_log_density
+from brancher.kernels import cauchy_log_density
 
 # TODO: This module is messy with ad hoc solutions for every distribution. You need to make everything more standardized.
 
@@ -32,6 +41,25 @@ class Distribution(ABC):
     def get_sample(self, *parameters):
         pass
 
+    def has_analytic_entropy(self):
+        return False
+
+    def has_analytic_kl(self, other):
+        return False
+
+    def has_probabilities(self):
+        return False
+
+    def calculate_entropy(self, **parameters):
+        raise NotImplementedError("The entropy of {} cannot be computed analytically.".format(type(self).__name__))
+
+    def calculate_kl_divergence(self, other, parameters, other_parameters):
+        raise NotImplementedError("The KL divergence between {} and {} cannot be computed analytically.".format(
+            type(self).__name__, type(other).__name__))
+
+    def get_probabilities(self, **parameters):
+        raise NotImplementedError("{} does not have class probabilities.".format(type(self).__name__))
+
 
 ## Implicit distributions ##
 class ImplicitDistribution(Distribution):
@@ -54,21 +82,91 @@ class EmpiricalDistribution(ImplicitDistribution):
         -------
         Without replacement
         """
-        if not indices:
+        if indices is None or len(indices) == 0:
             if isinstance(dataset, chainer.Variable):
                 dataset_size = dataset.shape[1]
             else:
                 dataset_size = len(dataset)
             if dataset_size < number_samples:
                 raise ValueError("It is impossible to have more samples than the size of the dataset without replacement")
-            indices = np.random.choice(range(dataset_size), size=self.batch_size, replace=False)
+            indices = get_random_state().choice(range(dataset_size), size=self.batch_size, replace=False)
         if isinstance(dataset, chainer.Variable):
             sample = dataset[:, indices, :]
+        elif isinstance(dataset, Dataset):
+            sample = coerce_to_dtype(dataset.get_rows(indices), is_observed=True)
         else:
             sample = list(np.array(dataset)[indices]) #TODO: clean up
         return sample
 
 
+class RandomIndicesDistribution(ImplicitDistribution):
+    """
+    Summary
+
+    Parameters
+    ----------
+    dataset_size : int
+    batch_size : int
+    full_epochs : bool
+        If True every datapoint is returned exactly once per epoch, and the batch at the end of an epoch is completed
+        with datapoints of the next one. Otherwise the datapoints left at the end of an epoch are skipped.
+    """
+    def __init__(self, dataset_size, batch_size, full_epochs=False):
+        if batch_size > dataset_size:
+            raise ValueError("It is impossible to have more samples than the size of the dataset without replacement")
+        self.dataset_size = dataset_size
+        self.batch_size = batch_size
+        self.full_epochs = full_epochs
+        self._permutation = get_random_state().permutation(dataset_size)
+        self._position = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _start_epoch(self, skipped_indices=()):
+        permutation = get_random_state().permutation(self.dataset_size)
+        number_missing = self.batch_size - len(skipped_indices)
+        if number_missing == self.batch_size:
+            self._permutation = permutation
+        else:
+            is_skipped = np.zeros(self.dataset_size, dtype=bool)
+            is_skipped[skipped_indices] = True
+            is_available = ~is_skipped[permutation]
+            is_head = is_available & (np.cumsum(is_available) <= number_missing)
+            self._permutation = np.concatenate((permutation[is_head], permutation[~is_head]))
+        self._position = number_missing
+        return self._permutation[:number_missing]
+
+    def get_sample(self, dataset, indices, number_samples):
+        """
+        One line description
+
+        Parameters
+        ----------
+        Returns
+        -------
+        np.ndarray. Integer indices of a minibatch, drawn without replacement from a shuffled epoch permutation.
+        """
+        with self._lock:
+            end = self._position + self.batch_size
+            if end <= self.dataset_size:
+                sample = self._permutation[self._position:end]
+                self._position = end
+            elif self.full_epochs:
+                tail = self._permutation[self._position:]
+                sample = np.concatenate((tail, self._start_epoch(skipped_indices=tail)))
+            else:
+                sample = self._start_epoch()
+        return sample
+
+
 ## Univariate distributions ##
 class UnivariateDistribution(Distribution):
     pass
@@ -89,8 +187,7 @@ class NormalDistribution(UnivariateDistribution):
         -------
         """
         x, mu, sigma = broadcast_and_squeeze(x, mu, sigma)
-        log_probability = -0.5*F.log(2*np.pi*sigma**2) - 0.5*(x-mu)**2/(sigma**2)
-        return sum_data_dimensions(log_probability)
+        return normal_log_density(x, mu, sigma)
 
     def get_sample(self, mu, sigma, number_samples):
         """
@@ -103,9 +200,49 @@ class NormalDistribution(UnivariateDistribution):
         -------
         """
         mean, var = broadcast_and_squeeze(mu, sigma)
-        sample = mean + sigma*np.random.normal(0, 1, size=mean.shape)
+        sample = mean + sigma*get_random_state().normal(0, 1, size=mean.shape)
         return sample
 
+    def has_analytic_entropy(self):
+        return True
+
+    def has_analytic_kl(self, other):
+        return isinstance(other, NormalDistribution)
+
+    def calculate_entropy(self, mu, sigma):
+        """
+        One line description
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        """
+        mu, sigma = broadcast_and_squeeze(mu, sigma)
+        entropy = 0.5*F.log(2*np.pi*np.e*sigma**2)
+        return sum_data_dimensions(entropy)
+
+    def calculate_kl_divergence(self, other, parameters, other_parameters):
+        """
+        One line description
+
+        Parameters
+        ----------
+        other : NormalDistribution
+        parameters : dict
+            Parameters (mu and sigma) of this distribution.
+        other_parameters : dict
+            Parameters (mu and sigma) of the other distribution.
+
+        Returns
+        -------
+        """
+        mu, sigma, other_mu, other_sigma = broadcast_and_squeeze(parameters["mu"], parameters["sigma"],
+                                                                 other_parameters["mu"], other_parameters["sigma"])
+        kl_divergence = F.log(other_sigma) - F.log(sigma) + (sigma**2 + (mu - other_mu)**2)/(2*other_sigma**2) - 0.5
+        return sum_data_dimensions(kl_divergence)
+
 
 class CauchyDistribution(UnivariateDistribution):
     """
@@ -122,8 +259,7 @@ class CauchyDistribution(UnivariateDistribution):
         -------
         """
         x, mu, sigma = broadcast_and_squeeze(x, mu, sigma)
-        log_probability = -F.log(1 + (x-mu)**2/sigma**2)
-        return sum_data_dimensions(log_probability)
+        return cauchy_log_density(x, mu, sigma)
 
     def get_sample(self, mu, sigma, number_samples):
         """
@@ -136,7 +272,7 @@ class CauchyDistribution(UnivariateDistribution):
         -------
         """
         mu, sigma = broadcast_and_squeeze(mu, sigma)
-        sample = mu + sigma*F.tan(np.pi*np.random.uniform(0,1,size=mu.shape).astype(np.float32))
+        sample = mu + sigma*F.tan(np.pi*get_random_state().uniform(0,1,size=mu.shape).astype(np.float32))
         return sample
 
 
@@ -155,8 +291,7 @@ class LogNormalDistribution(UnivariateDistribution):
         -------
         """
         x, mu, sigma = broadcast_and_squeeze(x, mu, sigma)
-        log_probability = -0.5*np.log(2*np.pi) - F.log(x) - F.log(sigma) - 0.5*(F.log(x)-mu)**2/(sigma**2)
-        return sum_data_dimensions(log_probability)
+        return log_normal_log_density(x, mu, sigma)
 
     def get_sample(self, mu, sigma, number_samples):
         """
@@ -169,7 +304,7 @@ class LogNormalDistribution(UnivariateDistribution):
         -------
         """
         mu, sigma = broadcast_and_squeeze(mu, sigma)
-        log_sample = mu + sigma*np.random.normal(0,1,size=mu.shape)
+        log_sample = mu + sigma*get_random_state().normal(0,1,size=mu.shape)
         return F.exp(log_sample)
 
 
@@ -187,11 +322,8 @@ class LogitNormalDistribution(UnivariateDistribution):
         Returns
         -------
         """
-        def logit(p):
-            return F.log(p) - F.log(1-p)
         x, mu, sigma = broadcast_and_squeeze(x, mu, sigma)
-        log_probability = -0.5*np.log(2*np.pi) - F.log(x) - F.log(1-x) - F.log(sigma) - 0.5*(logit(x)-mu)**2/(sigma**2)
-        return sum_data_dimensions(log_probability)
+        return logit_normal_log_density(x, mu, sigma)
 
     def get_sample(self, mu, sigma, number_samples):
         """
@@ -204,7 +336,7 @@ class LogitNormalDistribution(UnivariateDistribution):
         -------
         """
         mu, sigma = broadcast_and_squeeze(mu, sigma)
-        logit_sample = mu + sigma*np.random.normal(0,1,size=mu.shape)
+        logit_sample = mu + sigma*get_random_state().normal(0,1,size=mu.shape)
         return F.sigmoid(logit_sample)
 
 
@@ -238,7 +370,7 @@ class BinomialDistribution(UnivariateDistribution):
         -------
         """
         n, p = broadcast_and_squeeze(n, p)
-        binomial_sample = np.random.binomial(n.data, p.data) #TODO: Not reparametrizable (Gumbel?)
+        binomial_sample = get_random_state().binomial(n.data, p.data) #TODO: Not reparametrizable (Gumbel?)
         return chainer.Variable(binomial_sample.astype("int32"))
 
 
@@ -276,7 +408,7 @@ class LogitBinomialDistribution(UnivariateDistribution):
         -------
         """
         n, z = broadcast_and_squeeze(n, z)
-        binomial_sample = np.random.binomial(n.data, F.sigmoid(z).data) #TODO: Not reparametrizable (Gumbel?)
+        binomial_sample = get_random_state().binomial(n.data, F.sigmoid(z).data) #TODO: Not reparametrizable (Gumbel?)
         return chainer.Variable(binomial_sample.astype("int32"))
 
 
@@ -316,7 +448,7 @@ class CholeskyMultivariateNormal(MultivariateDistribution): #TODO: This needs to
             Returns
             -------
             """
-            random_vector = np.random.normal(0,1,size=mu.shape).astype("float32")
+            random_vector = get_random_state().normal(0,1,size=mu.shape).astype("float32")
             return mu + F.matmul(chol_cov, random_vector)
 
 class CategoricalDistribution(MultivariateDistribution):
@@ -349,17 +481,37 @@ class CategoricalDistribution(MultivariateDistribution):
         -------
         """
         p_values = p.data
-        p_shape = p_values.shape
-        sample = np.swapaxes(np.array([[np.random.multinomial(1, p_values[j, k, :])
-                                        for j in range(p_shape[0])]
-                                       for k in range(p_shape[1])]), axis1=0, axis2=1)
-        return chainer.Variable(sample.astype("int32"))
+        indices = sample_categorical_indices(p_values, axis=2)
+        sample = get_one_hot(indices, number_classes=p_values.shape[2], axis=2)
+        return chainer.Variable(sample)
 
+    def has_probabilities(self):
+        return True
 
-class SoftmaxCategoricalDistribution(MultivariateDistribution): #TODO: Work in progress!!!
-    """
-        Summary
+    def get_probabilities(self, p):
+        """
+        One line description
+
+        Parameters
+        ----------
+
+        Returns
+        -------
         """
+        return p/F.broadcast_to(F.sum(p, axis=2, keepdims=True), p.shape)
+
+
+class SoftmaxCategoricalDistribution(MultivariateDistribution):
+    """
+    Summary
+
+    Parameters
+    ----------
+    one_hot : bool
+        If True the samples are one-hot encoded along the class axis, otherwise they are class indices.
+    """
+    def __init__(self, one_hot=True):
+        self.one_hot = one_hot
 
     def calculate_log_probability(self, x, z):
         """
@@ -367,15 +519,31 @@ class SoftmaxCategoricalDistribution(MultivariateDistribution): #TODO: Work in p
 
         Parameters
         ----------
+        x : chainer.Variable
+            Either class indices (size one along the class axis) or one-hot encoded samples. The axes after the
+            class axis only need to have the same size as those of z, so (samples, datapoints, 1) indices can be
+            used with (samples, datapoints, classes, 1) logits.
+        z : chainer.Variable
+            Logits. The class axis is the third axis and any number of trailing axes is allowed.
 
         Returns
         -------
         """
-        reshaped_dict, n_samples, n_datapoints = broadcast_parent_values({"x": x, "z": z})
-        labels = np.reshape(reshaped_dict["x"].data, newshape=(n_samples*n_datapoints, 1))
-        log_probability = -F.softmax_cross_entropy(reshaped_dict["z"], labels, reduce="no")
-        log_probability = F.reshape(log_probability, shape=(n_samples, n_datapoints))
-        return log_probability
+        number_classes = z.shape[2]
+        data_shape = z.shape[3:]
+        x_values = x.data if isinstance(x, chainer.Variable) else np.array(x)
+        batch_shape = (max(x_values.shape[0], z.shape[0]), max(x_values.shape[1], z.shape[1]))
+        log_p = F.broadcast_to(F.log_softmax(z, axis=2), batch_shape + z.shape[2:])
+        if x_values.shape[2] == 1 and number_classes > 1:
+            indices = np.reshape(x_values, x_values.shape[:2] + data_shape)
+            indices = np.broadcast_to(indices, batch_shape + data_shape).astype("int32")
+            flat_log_p = F.reshape(F.moveaxis(log_p, 2, -1), (-1, number_classes))
+            log_probability = F.reshape(F.select_item(flat_log_p, np.ravel(indices)), batch_shape + data_shape)
+        else:
+            x_values = np.reshape(x_values, x_values.shape[:2] + z.shape[2:])
+            x_values = np.broadcast_to(x_values, log_p.shape).astype(log_p.dtype)
+            log_probability = F.sum(x_values*log_p, axis=2)
+        return sum_data_dimensions(log_probability)
 
     def get_sample(self, z, number_samples):
         """
@@ -387,16 +555,29 @@ class SoftmaxCategoricalDistribution(MultivariateDistribution): #TODO: Work in p
         Returns
         -------
         """
-        # import matplotlib.pyplot as plt
-        # [plt.plot(z.data[k, 0, :, 0]) for k in range(10)] #TODO: Work in progress
-        p_values = F.softmax(z, axis=2).data
-        p_shape = p_values.shape
-        p_values = np.reshape(p_values.astype("float64"), newshape=p_shape[:2] + tuple([np.prod(p_shape[2:])])) #TODO: This should go in a more general class (Future refactoring)
-        sample = np.swapaxes(np.array([[np.random.multinomial(1, p_values[j, k, :]/np.sum(p_values[j, k, :]))
-                                        for j in range(p_shape[0])]
-                                       for k in range(p_shape[1])]), axis1=0, axis2=1)
-        sample = np.reshape(sample, newshape=p_shape)
-        return chainer.Variable(sample.astype("int32"))
+        z_values = z.data
+        gumbel_sample = get_random_state().gumbel(0, 1, size=z_values.shape)
+        indices = np.expand_dims(np.argmax(z_values + gumbel_sample, axis=2), axis=2)
+        if self.one_hot:
+            sample = get_one_hot(indices, number_classes=z_values.shape[2], axis=2)
+        else:
+            sample = indices.astype("int32")
+        return chainer.Variable(sample)
+
+    def has_probabilities(self):
+        return True
+
+    def get_probabilities(self, z):
+        """
+        One line description
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        """
+        return F.softmax(z, axis=2)
 
 
 class ConcreteDistribution(MultivariateDistribution):
@@ -431,7 +612,7 @@ class ConcreteDistribution(MultivariateDistribution):
         -------
         """
         p, tau = F.broadcast(p, tau)
-        gumbel_sample = np.random.gumbel(0, 1, size=p.shape)
+        gumbel_sample = get_random_state().gumbel(0, 1, size=p.shape)
         return F.softmax((F.log(p) + gumbel_sample)/tau, axis=2)
 
 
@@ -0,0 +1,318 @@
+"""
+Expressions
+---------
+Expression graphs of the links. The value of a link is described by a DAG of variable, constant and operation nodes.
+The deterministic nodes are hash-consed, so that structurally equal subexpressions are the same node, and the operations
+whose operands are all constants are folded when they are constructed.
+"""
+from abc import ABC, abstractmethod
+import functools
+import numbers
+import operator
+import weakref
+
+import numpy as np
+
+from brancher.utilities import batch_apply
+from brancher.utilities import broadcast_batch_axes
+from brancher.utilities import topological_sort
+
+_interned_nodes = weakref.WeakValueDictionary()
+_named_operations = {}
+_shared_operations = weakref.WeakValueDictionary()
+
+
+def _intern(key, build):
+    node = _interned_nodes.get(key)
+    if node is None:
+        node = build()
+        _interned_nodes[key] = node
+    return node
+
+
+def _constant_key(value):
+    """
+    It returns a hashable key that is equal for equal numbers, strings, slices and tuples of them. Any other constant,
+    as an array, is only equal to itself.
+    """
+    if isinstance(value, tuple):
+        return (tuple,) + tuple(_constant_key(x) for x in value)
+    elif isinstance(value, slice):
+        return slice, _constant_key(value.start), _constant_key(value.stop), _constant_key(value.step)
+    elif value is None or isinstance(value, (numbers.Number, str)):
+        return type(value), value
+    return id, id(value)
+
+
+def _is_foldable_constant(value):
+    """
+    It returns True if the value is a number, a np.ndarray or a tuple of them. Other constants, as the chainer
+    parameters, can change after the node is constructed and they are never folded.
+    """
+    if isinstance(value, tuple):
+        return all(_is_foldable_constant(x) for x in value)
+    return isinstance(value, (numbers.Number, np.ndarray))
+
+
+class Operation(object):
+    """
+    Operation of an expression node.
+
+    Parameters
+    ----------
+    fn : callable or chainer.Link
+        Function of values with the flat (samples*datapoints, ...) layout.
+    batch_fn : callable
+        Function of values with the (samples, datapoints, ...) layout. If None, the arguments are flattened before
+        calling fn.
+    links : set of chainer.Link
+        Learnable chainer links used by fn.
+    deterministic : bool
+        If False, the outputs of the operation are random and its nodes are neither shared nor folded.
+    name : str
+        If given, the operation is registered with this name and it is unpickled as the registered operation.
+        Otherwise, it is unpickled as the operation that get_operation returns for its functions and links.
+    """
+    def __init__(self, fn, batch_fn=None, links=(), deterministic=True, name=None):
+        self.fn = fn
+        self.batch_fn = batch_fn
+        self.links = frozenset(links)
+        self.deterministic = deterministic
+        self.name = name
+        if name is not None:
+            _named_operations[name] = self
+
+    def __reduce__(self):
+        if self.name is not None:
+            return get_named_operation, (self.name,)
+        return get_operation, (self.fn, self.batch_fn, self.links, self.deterministic)
+
+    @property
+    def is_foldable(self):
+        return self.deterministic and not self.links
+
+
+class ExpressionNode(ABC):
+    """
+    ExpressionNode is the abstract superclass of the nodes of an expression graph. The operands, variables and links of a
+    node are fixed when it is constructed. The nodes are pickled as calls to their constructor functions, so that the
+    unpickled nodes are interned again.
+    """
+    __slots__ = ("operands", "vars", "links", "__weakref__")
+
+    def __init__(self, operands=(), vars=frozenset(), links=frozenset()):
+        self.operands = tuple(operands)
+        self.vars = frozenset(vars).union(*[node.vars for node in self.operands])
+        self.links = frozenset(links).union(*[node.links for node in self.operands])
+
+    @abstractmethod
+    def evaluate(self, values, operands):
+        """
+        Abstract method. It returns the value of the node from the values of the variables with the flat
+        (samples*datapoints, ...) layout and the values of its operands.
+        """
+        pass
+
+    def evaluate_batch(self, values, operands):
+        """
+        Method. It returns the value of the node from the values of the variables with the (samples, datapoints, ...)
+        layout and the values of its operands.
+        """
+        return self.evaluate(values, operands)
+
+
+class VariableNode(ExpressionNode):
+    __slots__ = ("variable",)
+
+    def __init__(self, variable):
+        super().__init__(vars={variable})
+        self.variable = variable
+
+    def __reduce__(self):
+        return variable_node, (self.variable,)
+
+    def evaluate(self, values, operands):
+        return values[self.variable]
+
+
+class ConstantNode(ExpressionNode):
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        super().__init__()
+        self.value = value
+
+    def __reduce__(self):
+        return constant_node, (self.value,)
+
+    def evaluate(self, values, operands):
+        return self.value
+
+
+class OperationNode(ExpressionNode):
+    __slots__ = ("operation", "kwarg_names")
+
+    def __init__(self, operation, operands, kwarg_names=()):
+        super().__init__(operands, links=operation.links)
+        self.operation = operation
+        self.kwarg_names = kwarg_names
+
+    def __reduce__(self):
+        args, kwargs = self._split_operands(self.operands)
+        return operation_node, (self.operation, args, kwargs)
+
+    def _split_operands(self, operands):
+        number_args = len(operands) - len(self.kwarg_names)
+        return operands[:number_args], dict(zip(self.kwarg_names, operands[number_args:]))
+
+    def evaluate(self, values, operands):
+        if not self.kwarg_names:
+            return self.operation.fn(*operands)
+        args, kwargs = self._split_operands(operands)
+        return self.operation.fn(*args, **kwargs)
+
+    def evaluate_batch(self, values, operands):
+        args, kwargs = self._split_operands(operands)
+        if self.operation.batch_fn is None:
+            return batch_apply(self.operation.fn, args, kwargs)
+        return self.operation.batch_fn(*args, **kwargs)
+
+
+def variable_node(variable):
+    return _intern((VariableNode, variable), lambda: VariableNode(variable))
+
+
+def constant_node(value):
+    return _intern((ConstantNode, _constant_key(value)), lambda: ConstantNode(value))
+
+
+def operation_node(operation, args, kwargs={}):
+    """
+    It returns the node that applies an operation to the given operand nodes. Deterministic nodes are shared with the
+    structurally equal nodes that already exist and the operations of numbers and arrays are folded into a constant node.
+
+    Args:
+        operation: brancher.expressions.Operation.
+
+        args: Iterable of brancher.expressions.ExpressionNode. Positional operands.
+
+        kwargs: Dictionary(String: brancher.expressions.ExpressionNode). Keyword operands.
+
+    Returns:
+        brancher.expressions.ExpressionNode.
+    """
+    kwarg_names = tuple(kwargs.keys())
+    operands = tuple(args) + tuple(kwargs[name] for name in kwarg_names)
+    if operation.is_foldable and all(isinstance(node, ConstantNode) and _is_foldable_constant(node.value)
+                                     for node in operands):
+        constant_args = [node.value for node in args]
+        constant_kwargs = {name: node.value for name, node in kwargs.items()}
+        return constant_node(operation.fn(*constant_args, **constant_kwargs))
+    if not operation.deterministic:
+        return OperationNode(operation, operands, kwarg_names)
+    return _intern((operation, operands, kwarg_names), lambda: OperationNode(operation, operands, kwarg_names))
+
+
+def get_named_operation(name):
+    return _named_operations[name]
+
+
+def get_operation(fn, batch_fn=None, links=(), deterministic=True):
+    """
+    It returns the unnamed operation of the given functions and links. The operation is shared by all the calls with
+    the same arguments, so that the unpickled operations are the ones used by the expressions built after loading and
+    their nodes are interned together.
+
+    Args:
+        fn: Callable or chainer.Link.
+
+        batch_fn: Callable.
+
+        links: Iterable of chainer.Link.
+
+        deterministic: Bool.
+
+    Returns:
+        brancher.expressions.Operation.
+    """
+    links = frozenset(links)
+    key = (fn, batch_fn, links, deterministic)
+    operation = _shared_operations.get(key)
+    if operation is None:
+        operation = Operation(fn, batch_fn, links, deterministic)
+        _shared_operations[key] = operation
+    return operation
+
+
+def broadcast_operator(op, *args):
+    return op(*broadcast_batch_axes(*args))
+
+
+def batch_getitem(value, key):
+    return value[(slice(None, None, None),) + key]
+
+
+def get_shape(value):
+    return value.shape
+
+
+def make_tuple(*args):
+    return args
+
+
+arithmetic_operations = {op: Operation(op, functools.partial(broadcast_operator, op), name=op.__name__)
+                         for op in [operator.add, operator.sub, operator.mul, operator.truediv, operator.pow]}
+getitem_operation = Operation(operator.getitem, batch_getitem, name="getitem")
+shape_operation = Operation(get_shape, name="shape")
+tuple_operation = Operation(make_tuple, make_tuple, name="tuple")
+
+
+class ExpressionEvaluator(object):
+    """
+    Evaluation plan of the expression graph of one or more root nodes. The distinct nodes are sorted once when the plan
+    is constructed, so that an evaluation computes every node a single time even when it is shared by several roots.
+    The evaluations can also share a memo of node values, so that the nodes shared by several plans are computed once.
+
+    Parameters
+    ----------
+    roots : iterable of brancher.expressions.ExpressionNode
+    batch : bool
+        If True, the values have the (samples, datapoints, ...) layout. Otherwise, they have the flat
+        (samples*datapoints, ...) layout.
+    """
+    def __init__(self, roots, batch=False):
+        self.roots = tuple(roots)
+        nodes = topological_sort(self.roots, lambda node: node.operands)
+        positions = {node: position for position, node in enumerate(nodes)}
+        self.steps = tuple((node, node.evaluate_batch if batch else node.evaluate,
+                            tuple(positions[operand] for operand in node.operands))
+                           for node in nodes)
+        self.root_positions = tuple(positions[root] for root in self.roots)
+
+    def evaluate(self, values, memo=None):
+        """
+        Method. It returns the list of values of the roots.
+
+        Args:
+            values: Dictionary(brancher.Variable: chainer.Variable). Values of the variables.
+
+            memo: Dictionary(brancher.expressions.ExpressionNode: Object). If given, the nodes stored in it are not
+            computed again and the computed nodes are added to it. It can only be shared by evaluations with the same
+            layout and the same values of the variables.
+
+        Returns:
+            List.
+        """
+        results = []
+        if memo is None:
+            for _, evaluate, positions in self.steps:
+                results.append(evaluate(values, [results[position] for position in positions]))
+        else:
+            for node, evaluate, positions in self.steps:
+                if node not in memo:
+                    memo[node] = evaluate(values, [results[position] for position in positions])
+                results.append(memo[node])
+        return [results[position] for position in self.root_positions]
+
+    def __call__(self, values):
+        return self.evaluate(values)[0]
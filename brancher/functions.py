@@ -1,39 +1,91 @@
+import sys
 import types
 
 import chainer
 import chainer.functions as F
 
-from brancher.variables import var2link
+from brancher.variables import var2node
 from brancher.variables import Variable, PartialLink
+from brancher.expressions import get_operation, operation_node
+from brancher.utilities import batch_matmul
+
+elementwise_functions = {"absolute", "arccos", "arcsin", "arctan", "ceil", "clipped_relu", "cos", "cosh", "elu", "erf",
+                         "erfc", "exp", "expm1", "fix", "floor", "hard_sigmoid", "leaky_relu", "log", "log10", "log1p",
+                         "log2", "relu", "rsqrt", "selu", "sigmoid", "sign", "sin", "sinh", "softplus", "sqrt", "square",
+                         "tan", "tanh"}
+
+
+def _get_code_objects(obj):
+    """
+    It returns the code objects of a function or of the methods of a class, including their nested functions.
+    """
+    if isinstance(obj, (staticmethod, classmethod)):
+        obj = obj.__func__
+    elif isinstance(obj, property):
+        obj = obj.fget
+    if isinstance(obj, types.FunctionType):
+        codes = [obj.__code__]
+        for code in codes:
+            codes.extend(const for const in code.co_consts if isinstance(const, types.CodeType))
+        return codes
+    elif isinstance(obj, type):
+        return [code for attribute in vars(obj).values() for code in _get_code_objects(attribute)]
+    return []
+
+
+def draws_random_numbers(fn):
+    """
+    It returns True if the chainer module that defines a function, or the class of a link, draws numbers from a random
+    state (as xp.random) in any of its functions and methods. Only the names used by the code are inspected, not the
+    docstrings. The functions defined outside of chainer are assumed to be deterministic.
+    """
+    module_name = getattr(fn if isinstance(fn, types.FunctionType) else type(fn), "__module__", None) or ""
+    module = sys.modules.get(module_name)
+    if module is None or not module_name.startswith("chainer."):
+        return False
+    return any("random" in code.co_names
+               for obj in vars(module).values() if getattr(obj, "__module__", None) == module.__name__
+               for code in _get_code_objects(obj))
 
 
 class BrancherFunction(object):
+    """
+    Summary
 
-    def __init__(self, fn):
+    Parameters
+    ----------
+    fn : callable or chainer.Link
+        Function of values with the flat (samples*datapoints, ...) layout.
+    batch_fn : callable
+        Function of values with the (samples, datapoints, ...) layout. If None, the arguments are flattened before
+        calling fn.
+    deterministic : bool
+        It has to be False if the output of fn is random, so that its calls are not shared or folded as the same
+        expression. If None, it is False when fn is a chainer function or link that draws from a random state.
+    """
+    def __init__(self, fn, batch_fn=None, deterministic=None):
         self.fn = fn
+        self.batch_fn = batch_fn
+        if deterministic is None:
+            deterministic = not draws_random_numbers(fn)
+        self.deterministic = deterministic
         if isinstance(fn, (chainer.Link, chainer.Chain, chainer.ChainList)):
             self.links = {fn}
         else:
             self.links = set()
+        self.operation = get_operation(fn, batch_fn, self.links, self.deterministic)
 
     def __call__(self, *args, **kwargs):
-        link_args = [var2link(arg) for arg in args]
-        link_kwargs = {name: var2link(arg) for name, arg in kwargs.items()}
-        arg_vars = {var for link in link_args if isinstance(link, PartialLink) for var in link.vars}
-        kwarg_vars = {var for _, link in link_kwargs.items() if isinstance(link, PartialLink) for var in link.vars}
-
-        def fn(values):
-            args = [x.fn(values) if isinstance(x, PartialLink) else x for x in link_args]
-            kwargs = dict({(name, x.fn(values)) if isinstance(x, PartialLink) else (name, x)
-                           for name, x in link_kwargs.items()})
-            return self.fn(*args, **kwargs)
-
-        return PartialLink(arg_vars.union(kwarg_vars), fn, self.links)
+        return PartialLink(operation_node(self.operation,
+                                          [var2node(arg) for arg in args],
+                                          {name: var2node(arg) for name, arg in kwargs.items()}))
 
     def _is_var(self, arg):
         return isinstance(arg, (Variable, PartialLink))
 
 
 is_chainer_fn = lambda k, v: type(v) is types.FunctionType and not k.startswith('_')
-brancher_fns = {name: BrancherFunction(v) for name, v in F.__dict__.items() if is_chainer_fn(name, v)}
+brancher_fns = {name: BrancherFunction(v, batch_fn=v if name in elementwise_functions else None)
+                for name, v in F.__dict__.items() if is_chainer_fn(name, v)}
+brancher_fns["matmul"] = BrancherFunction(F.matmul, batch_fn=batch_matmul)
 globals().update(brancher_fns)
@@ -3,6 +3,9 @@ Inference
 ---------
 Module description
 """
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
 import warnings
 
 import chainer
@@ -12,6 +15,7 @@ from tqdm import tqdm
 
 from brancher.optimizers import ProbabilisticOptimizer
 from brancher.variables import DeterministicVariable, ProbabilisticModel
+from brancher.utilities import isolated_sampling
 
 
 # def maximal_likelihood(random_variable, number_iterations, optimizer=chainer.optimizers.SGD(0.001)):
@@ -37,32 +41,153 @@ from brancher.variables import DeterministicVariable, ProbabilisticModel
 #     return loss_list
 
 
+class ObservedSamplePrefetcher(object):
+    """
+    Background loader of the observed samples of a model. A worker thread draws the next minibatches (random indices,
+    gathered rows and dtype conversion) while the current iteration is computed. The worker draws its random numbers
+    from its own random state and does not use the memoized values of the model, so the minibatches of a seeded run
+    are reproducible and do not depend on the scheduling of the threads. It is a context manager that stops the worker
+    when the block exits, also when it raises.
+
+    Parameters
+    ----------
+    model : brancher.ProbabilisticModel
+        The observed submodel that is sampled.
+    number_prefetched : int
+        Number of samples that are prepared in advance.
+    seed : int
+        Seed of the random state of the worker. If None, it is drawn from the global numpy random state.
+    """
+    def __init__(self, model, number_prefetched=2, seed=None):
+        self.model = model
+        self.model._get_sampling_schedule(observed=True, input_values={})
+        if seed is None:
+            seed = np.random.randint(0, 2**31 - 1)
+        self._random_state = np.random.RandomState(seed)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures = collections.deque()
+        try:
+            for _ in range(number_prefetched):
+                self._futures.append(self._executor.submit(self._draw_sample))
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _draw_sample(self):
+        with isolated_sampling(self._random_state):
+            return self.model._get_sample(1, observed=True)
+
+    def get_sample(self):
+        """
+        It returns the oldest prefetched sample and schedules a new one.
+        """
+        future = self._futures.popleft()
+        self._futures.append(self._executor.submit(self._draw_sample))
+        return future.result()
+
+    def close(self):
+        for future in self._futures:
+            future.cancel()
+        self._futures.clear()
+        self._executor.shutdown(wait=True)
+
+
+def get_probabilistic_optimizer(joint_model, optimizer):
+    """
+    It returns a single ProbabilisticOptimizer over the parameters of the joint model and of its posterior model. The
+    optimizer is cached in the joint model and reused, together with its state, by the following calls with the same
+    chainer optimizer as long as the parameters of the models do not change.
+
+    Parameters
+    ---------
+    joint_model : brancher.ProbabilisticModel
+    optimizer : chainer optimizer
+    """
+    models = [joint_model, joint_model.posterior_model]
+    prob_optimizer = joint_model.probabilistic_optimizer
+    if prob_optimizer is None or not prob_optimizer.is_setup(models, optimizer):
+        prob_optimizer = ProbabilisticOptimizer(models, optimizer)
+        joint_model.probabilistic_optimizer = prob_optimizer
+    return prob_optimizer
+
+
+def get_sample_chunks(number_samples, sample_chunk_size=None):
+    """
+    It returns the sizes of the chunks in which the Monte Carlo samples of an iteration are evaluated. All the chunks
+    have sample_chunk_size samples except the last one, which has the remaining samples.
+
+    Parameters
+    ---------
+    number_samples : int
+    sample_chunk_size : int
+        If None, all the samples are in a single chunk.
+    """
+    if not sample_chunk_size:
+        return [number_samples]
+    sample_chunks = [sample_chunk_size]*(number_samples // sample_chunk_size)
+    if number_samples % sample_chunk_size:
+        sample_chunks.append(number_samples % sample_chunk_size)
+    return sample_chunks
+
+
 def stochastic_variational_inference(joint_model, number_iterations, number_samples,
                                      optimizer=chainer.optimizers.Adam(0.001),
-                                     input_values={}):
+                                     input_values={}, method="ELBO", prefetch=0, local_reparameterization=(),
+                                     sample_chunk_size=None):
     """
     Summary
 
     Parameters
     ---------
+    method : str
+        Estimator of the model evidence, see ProbabilisticModel.estimate_log_model_evidence. Using "analytic ELBO" reduces
+        the variance of the gradients when the posterior and the prior have analytic KL divergences.
+    prefetch : int
+        Number of observed minibatches that are prepared in a background thread. If 0, they are drawn synchronously.
+    local_reparameterization : iterable of brancher.RandomVariable
+        Normal posterior weights whose products with BF.matmul are sampled directly, see
+        ProbabilisticModel.estimate_log_model_evidence. It requires method="analytic ELBO".
+    sample_chunk_size : int
+        Maximum number of Monte Carlo samples evaluated at once. The samples of an iteration are split in chunks that
+        share the same observed sample and the gradients of the chunks are accumulated before the update, so the step is
+        the same as without chunks while the memory scales with the chunk size. If None, all the samples are evaluated
+        at once.
     """
     joint_model.update_observed_submodel() #TODO: Probably not here
-    posterior_model = joint_model.posterior_model
-    joint_optimizer = ProbabilisticOptimizer(joint_model, optimizer)
-    posterior_optimizer = ProbabilisticOptimizer(posterior_model, optimizer) #TODO: These things should not be here, maybe they should be inherited
+    prob_optimizer = get_probabilistic_optimizer(joint_model, optimizer)
+    sample_chunks = get_sample_chunks(number_samples, sample_chunk_size)
 
     loss_list = []
-    for iteration in tqdm(range(number_iterations)):
-        loss = -joint_model.estimate_log_model_evidence(number_samples=number_samples,
-                                                        method="ELBO", input_values=input_values)
-
-        if np.isfinite(loss.data).all():
-            posterior_optimizer.chain.cleargrads()
-            joint_optimizer.chain.cleargrads()
-            loss.backward()
-            joint_optimizer.update()
-            posterior_optimizer.update()
-            loss_list.append(loss.data)
-        else:
-            warnings.warn("Numerical error, skipping sample")
+    prefetcher = ObservedSamplePrefetcher(joint_model.observed_submodel, number_prefetched=prefetch) if prefetch else None
+    with prefetcher or contextlib.nullcontext():
+        for iteration in tqdm(range(number_iterations)):
+            if prefetcher:
+                observed_sample = prefetcher.get_sample()
+            elif len(sample_chunks) > 1:
+                observed_sample = joint_model.observed_submodel._get_sample(1, observed=True)
+            else:
+                observed_sample = None
+            prob_optimizer.chain.cleargrads()
+            loss_value = 0.
+            for chunk_size in sample_chunks:
+                loss = -(chunk_size/float(number_samples))*joint_model.estimate_log_model_evidence(
+                    number_samples=chunk_size, method=method, input_values=input_values,
+                    observed_sample=observed_sample, local_reparameterization=local_reparameterization)
+                if not np.isfinite(loss.data).all():
+                    loss_value = loss.data
+                    break
+                loss.backward()
+                loss_value += loss.data
+
+            if np.isfinite(loss_value).all():
+                prob_optimizer.update()
+                loss_list.append(loss_value)
+            else:
+                warnings.warn("Numerical error, skipping sample")
     joint_model.diagnostics.update({"loss curve": np.array(loss_list)})
@@ -0,0 +1,110 @@
+"""
+Kernels
+---------
+Fused chainer functions for the log-densities of the distributions. Every log-density is computed by a single function
+node that also sums it over the data dimensions, and its gradients are computed analytically.
+"""
+from abc import ABC, abstractmethod
+
+import numpy as np
+import chainer.functions as F
+from chainer import function_node
+from chainer.backends import cuda
+
+
+class LogDensity(function_node.FunctionNode, ABC):
+    """
+    Abstract fused log-density of a location-scale family. The inputs x, mu and sigma have the same
+    (samples, datapoints, data...) shape and the output is the log-density summed over the data dimensions, which has
+    shape (samples, datapoints).
+    """
+    def forward(self, inputs):
+        self.retain_inputs((0, 1, 2))
+        xp = cuda.get_array_module(*inputs)
+        log_density = self._log_density(xp, *inputs)
+        data_axes = tuple(range(2, log_density.ndim))
+        return xp.sum(log_density, axis=data_axes).astype(inputs[0].dtype, copy=False),
+
+    def backward(self, indexes, grad_outputs):
+        x, mu, sigma = self.get_retained_inputs()
+        gy, = grad_outputs
+        gy = F.broadcast_to(F.reshape(gy, gy.shape + (1,)*(x.ndim - 2)), x.shape)
+        return tuple(gy*gradient for gradient in self._gradients(x, mu, sigma))
+
+    @abstractmethod
+    def _log_density(self, xp, x, mu, sigma):
+        """
+        Abstract method. It returns the elementwise log-density of the arrays x given the arrays mu and sigma.
+        """
+        pass
+
+    @abstractmethod
+    def _gradients(self, x, mu, sigma):
+        """
+        Abstract method. It returns the elementwise derivatives of the log-density with respect to x, mu and sigma as
+        chainer variables, so that the gradients can be differentiated again.
+        """
+        pass
+
+
+class NormalLogDensity(LogDensity):
+
+    def _log_density(self, xp, x, mu, sigma):
+        z = (x - mu)/sigma
+        return -0.5*np.log(2*np.pi) - xp.log(sigma) - 0.5*z**2
+
+    def _gradients(self, x, mu, sigma):
+        z = (x - mu)/sigma
+        return -z/sigma, z/sigma, (z**2 - 1)/sigma
+
+
+class LogNormalLogDensity(LogDensity):
+
+    def _log_density(self, xp, x, mu, sigma):
+        log_x = xp.log(x)
+        z = (log_x - mu)/sigma
+        return -0.5*np.log(2*np.pi) - log_x - xp.log(sigma) - 0.5*z**2
+
+    def _gradients(self, x, mu, sigma):
+        z = (F.log(x) - mu)/sigma
+        return -(1 + z/sigma)/x, z/sigma, (z**2 - 1)/sigma
+
+
+class LogitNormalLogDensity(LogDensity):
+
+    def _log_density(self, xp, x, mu, sigma):
+        log_x, log_one_minus_x = xp.log(x), xp.log(1 - x)
+        z = (log_x - log_one_minus_x - mu)/sigma
+        return -0.5*np.log(2*np.pi) - log_x - log_one_minus_x - xp.log(sigma) - 0.5*z**2
+
+    def _gradients(self, x, mu, sigma):
+        z = (F.log(x) - F.log(1 - x) - mu)/sigma
+        return -1/x + 1/(1 - x) - z/(sigma*x*(1 - x)), z/sigma, (z**2 - 1)/sigma
+
+
+class CauchyLogDensity(LogDensity):
+
+    def _log_density(self, xp, x, mu, sigma):
+        z = (x - mu)/sigma
+        return -xp.log(1 + z**2)
+
+    def _gradients(self, x, mu, sigma):
+        z = (x - mu)/sigma
+        dz = -2*z/((1 + z**2)*sigma)
+        return dz, -dz, -z*dz
+
+
+def normal_log_density(x, mu, sigma):
+    return NormalLogDensity().apply((x, mu, sigma))[0]
+
+
+def log_normal_log_density(x, mu, sigma):
+    return LogNormalLogDensity().apply((x, mu, sigma))[0]
+
+
+def logit_normal_log_density(x, mu, sigma):
+    return LogitNormalLogDensity().apply((x, mu, sigma))[0]
+
+
+def cauchy_log_density(x, mu, sigma):
+    return CauchyLogDensity().apply((x, mu, sigma))[0]
@@ -7,9 +7,10 @@ from abc import ABC, abstractmethod
 import copy
 
 from chainer import optimizers, Link, Chain, ChainList
+import chainer.links as L
 
-from brancher.chains import EmptyChain
-from brancher.variables import BrancherClass, Variable, ProbabilisticModel
+from brancher.chains import EmptyChain, ParameterBuffer, ParameterView
+from brancher.variables import BrancherClass, Variable, DeterministicVariable
 
 
 PO_DEFAULT_APLHA = 0.001
@@ -24,34 +25,85 @@ class ProbabilisticOptimizer(ABC):
 
     Parameters
     ----------
+    model : brancher.BrancherClass or list of brancher.BrancherClass
+        Models or variables whose parameters are optimized.
     optimizer : chainer optimizer
         Summary
     """
     def __init__(self, model, optimizer=None):
+        self.source_optimizer = optimizer
         if optimizer is None:
-            optimizer = self._get_default_optimizer()
+            self.optimizer = self._get_default_optimizer()
         else:
             #TODO: Assert
             self.optimizer = copy.deepcopy(optimizer)
         self.link_set = set()
+        self.learnable_variables = []
+        self.parameter_buffers = []
         self.chain = None
         self.setup(model)
 
     @staticmethod
-    def _get_default_optimizer(self, **kwargs):
+    def _get_default_optimizer(**kwargs):
         optimizer = optimizers.Adam(alpha=PO_DEFAULT_APLHA, beta1=PO_DEFAULT_BETA1,
                                     beta2=PO_DEFAULT_BETA2, eps=PO_DEFAULT_EPS)
         return optimizer
 
+    @staticmethod
+    def _find_links(model):
+        """
+        It returns the chainer links and the learnable deterministic variables of the models. The variables are visited
+        once in the cached topological order of each model.
+        """
+        models = [model] if isinstance(model, BrancherClass) else list(model)
+        link_set = set()
+        learnable_variables = []
+        for submodel in models:
+            assert isinstance(submodel, BrancherClass)
+            for var in submodel._get_graph_index().topological_order:
+                link = getattr(var, "link", None)
+                if type(var) is DeterministicVariable and isinstance(link, (L.Bias, ParameterView)):
+                    if var not in learnable_variables:
+                        learnable_variables.append(var)
+                elif isinstance(link, Link) or isinstance(link, Chain) or isinstance(link, ChainList):
+                    link_set.add(link)
+        return link_set, learnable_variables
+
     def _update_link_set(self, random_variable):
-        assert isinstance(random_variable, BrancherClass)
-        link = random_variable.link if hasattr(random_variable, 'link') else None
-        if isinstance(link, Link) or isinstance(link, Chain) or isinstance(link, ChainList):
-            self.link_set.add(link)
+        link_set, learnable_variables = self._find_links(random_variable)
+        self.link_set.update(link_set)
+        self.learnable_variables.extend(var for var in learnable_variables if var not in self.learnable_variables)
 
-        vars_attr = 'variables' if isinstance(random_variable, ProbabilisticModel) else 'parents'
-        for var in getattr(random_variable, vars_attr):
-            self._update_link_set(var)
+    def is_setup(self, model, optimizer):
+        """
+        It returns True if the optimizer was built from the given chainer optimizer and it already optimizes all the
+        parameters of the models, so that it can be reused.
+        """
+        if optimizer is not self.source_optimizer:
+            return False
+        link_set, learnable_variables = self._find_links(model)
+        return (link_set.union(self.parameter_buffers) == self.link_set
+                and learnable_variables == self.learnable_variables
+                and all(isinstance(var.link, ParameterView) and var.link.buffer in self.parameter_buffers
+                        for var in learnable_variables))
+
+    def _pack_parameters(self):
+        """
+        It returns the list of ParameterBuffers that store the parameters of the learnable deterministic variables. The
+        parameters of the chainer.links.Bias links are stored in a new buffer and the variables that already have a
+        ParameterView keep it, so that the buffers shared with other models are neither copied nor modified.
+        """
+        buffers = []
+        for var in self.learnable_variables:
+            if isinstance(var.link, ParameterView) and var.link.buffer not in buffers:
+                buffers.append(var.link.buffer)
+        bias_variables = [var for var in self.learnable_variables if not isinstance(var.link, ParameterView)]
+        if bias_variables:
+            buffer = ParameterBuffer([var.link.b.array for var in bias_variables])
+            for index, var in enumerate(bias_variables):
+                var.link = ParameterView(buffer, index)
+            buffers.append(buffer)
+        return buffers
 
     def setup(self, random_variable):
         """
@@ -59,9 +111,13 @@ class ProbabilisticOptimizer(ABC):
         """
         self.chain = EmptyChain()
         self._update_link_set(random_variable)
+        self.parameter_buffers = self._pack_parameters()
+        self.link_set.update(self.parameter_buffers)
         for link in self.link_set:
             self.chain.add_link(link)
         self.optimizer.setup(self.chain)
 
     def update(self):
         self.optimizer.update()
+        for buffer in self.parameter_buffers:
+            buffer.invalidate()
@@ -3,41 +3,102 @@ import numpy as np
 import chainer
 
 import brancher.distributions as distributions
+import brancher.datasets as datasets
 import brancher.geometric_ranges as geometric_ranges
 from brancher.variables import var2link, Variable, DeterministicVariable, RandomVariable, PartialLink
+from brancher.expressions import ExpressionEvaluator
 from brancher.utilities import join_sets_list
+from brancher.utilities import is_memoizing
 import brancher.functions as BF
 
 
-class VariableConstructor(RandomVariable):
+class VarLink(chainer.ChainList):
     """
-    Summary
+    Link of the variables created by a VariableConstructor. It maps the values of the parents to the parameters of the
+    distribution.
 
     Parameters
     ----------
+    kwargs : Dictionary(String: brancher.Variable or brancher.PartialLink)
+        Parameters of the distribution.
     """
-    def __init__(self, name, learnable, ranges, is_observed=False, **kwargs):
+    def __init__(self, kwargs):
+        self.kwargs = kwargs
+        self.names = tuple(kwargs.keys())
+        self.partial_links = tuple(var2link(x) for x in kwargs.values())
+        self._compile()
+        links = [link
+                 for partial_link in self.partial_links
+                 for link in partial_link.links]
+        super().__init__(*links)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for name in ["parameter_inputs", "batch_names", "evaluator", "batch_evaluator", "parameter_evaluators", "memo"]:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compile()
+
+    def _compile(self):
+        nodes = dict(zip(self.names, [partial_link.node for partial_link in self.partial_links]))
+        self.parameter_inputs = {k: tuple(node.vars) for k, node in nodes.items()
+                                 if not node.links and all(type(var) is DeterministicVariable for var in node.vars)}
+        self.batch_names = tuple(k for k in self.names if k not in self.parameter_inputs)
+        self.evaluator = ExpressionEvaluator(nodes.values())
+        self.batch_evaluator = ExpressionEvaluator([nodes[k] for k in self.batch_names], batch=True)
+        self.parameter_evaluators = {k: ExpressionEvaluator([nodes[k]], batch=True) for k in self.parameter_inputs}
+        self.memo = {}
+
+    def __call__(self, values):
+        return dict(zip(self.names, self.evaluator.evaluate(values)))
+
+    def evaluate_batch(self, values, memo=None):
+        """
+        It returns the parameters of the distribution from the values of the parents with the (samples, datapoints, ...)
+        layout. The memo is shared by all the links evaluated in a sampling or log probability pass, so the
+        subexpressions shared by several links are computed once per pass.
+        """
+        parameters = dict(zip(self.batch_names, self.batch_evaluator.evaluate(values, memo)))
+        for k in self.parameter_inputs:
+            parameters[k] = self._evaluate_parameter(k, values, memo)
+        return parameters
+
+    def _evaluate_parameter(self, k, values, memo=None):
+        # The parameters that only depend on deterministic variables and on no chainer link are memoized until their
+        # inputs change
+        if not is_memoizing():
+            return self.parameter_evaluators[k].evaluate(values, memo)[0]
+        backprop = chainer.config.enable_backprop
+        inputs = tuple(values[var] for var in self.parameter_inputs[k])
+        memo = self.memo.get(k)
+        if (memo is None or memo[0] != backprop
+                or any(value is not memo_value for value, memo_value in zip(inputs, memo[1]))):
+            memo = (backprop, inputs, self.parameter_evaluators[k](values))
+            self.memo[k] = memo
+        return memo[2]
 
-        class VarLink(chainer.ChainList):
 
-            def __init__(self):
-                self.kwargs = kwargs
-                links = [link
-                         for partial_link in kwargs.values()
-                         for link in var2link(partial_link).links]
-                super().__init__(*links)
+class VariableConstructor(RandomVariable):
+    """
+    Summary
 
-            def __call__(self, values):
-                return {k: var2link(x).fn(values) for k, x in self.kwargs.items()}
+    Parameters
+    ----------
+    """
+    __slots__ = ("ranges",)
+
+    def __init__(self, name, learnable, ranges, is_observed=False, **kwargs):
 
         self.name = name
-        self._evaluated = False
         self._observed = is_observed
         self._observed_value = None
         self._current_value = None
         self.construct_deterministic_parents(learnable, ranges, kwargs)
-        self.parents = join_sets_list([var2link(x).vars for x in kwargs.values()])
-        self.link = VarLink()
+        self.link = VarLink(kwargs)
+        self.parents = join_sets_list([partial_link.vars for partial_link in self.link.partial_links])
         self.samples = []
         self.ranges = {}
         self.dataset = None
@@ -65,9 +126,17 @@ class EmpiricalVariable(VariableConstructor):
 
     Parameters
     ----------
+    dataset : chainer.Variable, np.ndarray, list, np.memmap, str or brancher.datasets.Dataset
+        The data. A np.memmap, the path of a .npy file or the path of a directory of .npy shards are read out-of-core
+        and only the rows of each minibatch are loaded in memory.
     """
+    __slots__ = ("batch_size", "dataset_size", "is_subsampled")
+
     def __init__(self, dataset, name, is_observed=True, batch_size=(), indices=()):
         self._type = "Empirical"
+        dataset = datasets.load_dataset(dataset)
+        self.dataset_size = len(dataset)
+        self.is_subsampled = isinstance(indices, RandomVariable) or len(indices) == 0
         ranges = {"dataset": geometric_ranges.UnboundedRange(),
                   "batch_size": geometric_ranges.UnboundedRange(),
                   "indices": geometric_ranges.UnboundedRange()}
@@ -78,10 +147,15 @@ class EmpiricalVariable(VariableConstructor):
             self.batch_size = batch_size
         elif indices:
             self.distribution.batch_size = len(indices)
-            self.batch_size = batch_size #TODO: Clean up here
+            self.batch_size = len(indices)
         else:
             raise ValueError("Either the indices or the batch size has to be given as input")
 
+    def _get_subsampling_ratio(self):
+        if self.is_subsampled:
+            return self.dataset_size/float(self.batch_size)
+        return 1.
+
 
 class RandomIndices(EmpiricalVariable):
     """
@@ -89,11 +163,16 @@ class RandomIndices(EmpiricalVariable):
 
     Parameters
     ----------
+    full_epochs : bool
+        If True every datapoint is visited exactly once per epoch.
     """
-    def __init__(self, dataset_size, batch_size, name, is_observed=False):
+    __slots__ = ()
+
+    def __init__(self, dataset_size, batch_size, name, is_observed=False, full_epochs=False):
         self._type = "Random Index"
-        super().__init__(dataset=list(range(dataset_size)),
+        super().__init__(dataset=range(dataset_size),
                          batch_size=batch_size, is_observed=is_observed, name=name)
+        self.distribution = distributions.RandomIndicesDistribution(dataset_size, batch_size, full_epochs)
 
     def __len__(self):
         return self.batch_size
@@ -106,6 +185,8 @@ class NormalVariable(VariableConstructor):
     Parameters
     ----------
     """
+    __slots__ = ()
+
     def __init__(self, mu, sigma, name, learnable=False):
         self._type = "Normal"
         ranges = {"mu": geometric_ranges.UnboundedRange(),
@@ -121,6 +202,8 @@ class CauchyVariable(VariableConstructor):
     Parameters
     ----------
     """
+    __slots__ = ()
+
     def __init__(self, mu, sigma, name, learnable=False):
         self._type = "Cauchy"
         ranges = {"mu": geometric_ranges.UnboundedRange(),
@@ -136,6 +219,8 @@ class LogNormalVariable(VariableConstructor):
     Parameters
     ----------
     """
+    __slots__ = ()
+
     def __init__(self, mu, sigma, name, learnable=False):
         self._type = "Log Normal"
         ranges = {"mu": geometric_ranges.UnboundedRange(),
@@ -151,6 +236,8 @@ class LogitNormalVariable(VariableConstructor):
     Parameters
     ----------
     """
+    __slots__ = ()
+
     def __init__(self, mu, sigma, name, learnable=False):
         self._type = "Logit Normal"
         ranges = {"mu": geometric_ranges.UnboundedRange(),
@@ -166,6 +253,8 @@ class BinomialVariable(VariableConstructor):
     Parameters
     ----------
     """
+    __slots__ = ()
+
     def __init__(self, n, p=None, logit_p=None, name="Binomial", learnable=False):
         self._type = "Binomial"
         if p is not None and logit_p is None:
@@ -190,7 +279,9 @@ class CategoricalVariable(VariableConstructor): #TODO: Work in progress
     Parameters
     ----------
     """
-    def __init__(self, p=None, softmax_p=None, name="Categorical", learnable=False):
+    __slots__ = ()
+
+    def __init__(self, p=None, softmax_p=None, name="Categorical", learnable=False, one_hot=True):
         self._type = "Categorical"
         if p is not None and softmax_p is None:
             ranges = {"p": geometric_ranges.Simplex()}
@@ -199,7 +290,7 @@ class CategoricalVariable(VariableConstructor): #TODO: Work in progress
         elif softmax_p is not None and p is None:
             ranges = {"z": geometric_ranges.UnboundedRange()}
             super().__init__(name, z=softmax_p, learnable=learnable, ranges=ranges)
-            self.distribution = distributions.SoftmaxCategoricalDistribution()
+            self.distribution = distributions.SoftmaxCategoricalDistribution(one_hot=one_hot)
         else:
             raise ValueError("Either p or " +
                              "softmax_p needs to be provided as input")
@@ -212,6 +303,8 @@ class ConcreteVariable(VariableConstructor):
     Parameters
     ----------
     """
+    __slots__ = ()
+
     def __init__(self, tau, p, name, learnable=False):
         self._type = "Concrete"
         ranges = {"tau": geometric_ranges.RightHalfLine(0.),
@@ -227,6 +320,8 @@ class MultivariateNormalVariable(VariableConstructor):
     Parameters
     ----------
     """
+    __slots__ = ()
+
     def __init__(self, mu, cov=None, chol_cov=None, diag_cov=None, name="Multivariate Normal", learnable=False):
         self._type = "Multivariate Normal"
         if chol_cov is not None and diag_cov is None:
@@ -5,11 +5,63 @@ Module description
 """
 from functools import reduce
 from collections import abc
+import contextlib
+import threading
 
 import numpy as np
 import chainer
 import chainer.functions as F
 
+from brancher.datasets import Dataset
+
+_thread_state = threading.local()
+
+LOCAL_REPARAMETERIZATION_EPS = 1e-8
+
+
+def get_random_state():
+    """
+    It returns the source of random numbers of the current thread. It is the global numpy random state unless the
+    thread is sampling in isolation.
+    """
+    return getattr(_thread_state, "random_state", np.random)
+
+
+def is_memoizing():
+    """
+    It returns False when the current thread is sampling in isolation, in which case the memoized values shared with
+    the other threads are neither read nor written.
+    """
+    return getattr(_thread_state, "memoize", True)
+
+
+def backprop_mode(backprop):
+    """
+    It returns a context manager that sets the enable_backprop configuration of chainer to backprop. If backprop is
+    None, the configuration of the caller is kept.
+    """
+    if backprop is None:
+        return contextlib.nullcontext()
+    return chainer.using_config("enable_backprop", backprop)
+
+
+@contextlib.contextmanager
+def isolated_sampling(random_state):
+    """
+    Context manager. Inside it, the current thread draws its random numbers from its own random state and it does not
+    use the memoized values shared with the other threads, so that sampling in a background thread does not interfere
+    with the main thread.
+
+    Args:
+        random_state: np.random.RandomState.
+    """
+    previous_state = (get_random_state(), is_memoizing())
+    _thread_state.random_state, _thread_state.memoize = random_state, False
+    try:
+        yield
+    finally:
+        _thread_state.random_state, _thread_state.memoize = previous_state
+
 
 def split_dict(dic, condition):
     dict_1 = {}
@@ -46,6 +98,33 @@ def join_sets_list(sets_list):
         return set()
 
 
+def topological_sort(roots, get_parents):
+    """
+    It returns all the nodes reachable from the roots ordered so that every node comes after its parents. The graph
+    is traversed iteratively and every node is visited once, so shared ancestors and long chains have linear cost.
+
+    Args:
+        roots: Iterable. The nodes from which the traversal starts.
+
+        get_parents: Callable. It returns the iterable of parents of a node.
+
+    Returns:
+        List.
+    """
+    sorted_nodes = []
+    visited = set()
+    stack = [(node, False) for node in reversed(list(roots))]
+    while stack:
+        node, expanded = stack.pop()
+        if expanded:
+            sorted_nodes.append(node)
+        elif node not in visited:
+            visited.add(node)
+            stack.append((node, True))
+            stack.extend((parent, False) for parent in get_parents(node) if parent not in visited)
+    return sorted_nodes
+
+
 def sum_data_dimensions(var):
     data_dim = len(var.shape)
     for dim in reversed(range(2, data_dim)):
@@ -59,6 +138,153 @@ def partial_broadcast(*args):
     return [F.broadcast_to(x, shape=(s0, s1) + x.shape[2:]) for x in args]
 
 
+def broadcast_add(x, y):
+    """
+    It adds two log probabilities, broadcasting their sample and datapoint axes when both are chainer variables.
+    """
+    if type(x) is chainer.Variable and type(y) is chainer.Variable:
+        x, y = partial_broadcast(x, y)
+    return x + y
+
+
+def broadcast_batch_axes(*args):
+    """
+    It broadcasts the sample and datapoint axes of the chainer variables among the arguments to their common size. The
+    broadcasted values are views, so nothing is copied. The other arguments are returned unchanged.
+    """
+    batch_shapes = [x.shape[:2] for x in args if isinstance(x, chainer.Variable)]
+    if len(set(batch_shapes)) < 2:
+        return list(args)
+    batch_shape = tuple(max(shape[axis] for shape in batch_shapes) for axis in range(2))
+    return [F.broadcast_to(x, shape=batch_shape + x.shape[2:])
+            if isinstance(x, chainer.Variable) and x.shape[:2] != batch_shape else x
+            for x in args]
+
+
+def reshape_batch_axes(value, number_samples, number_datapoints):
+    """
+    It reshapes the flat (samples*datapoints, ...) chainer variables in the value, which can also be a tuple, a list or
+    a dictionary, to the (samples, datapoints, ...) layout.
+    """
+    if isinstance(value, chainer.Variable):
+        if value.ndim > 0 and value.shape[0] == number_samples*number_datapoints:
+            return F.reshape(value, (number_samples, number_datapoints) + value.shape[1:])
+        return value
+    elif isinstance(value, (tuple, list)):
+        return type(value)(reshape_batch_axes(x, number_samples, number_datapoints) for x in value)
+    elif isinstance(value, dict):
+        return {key: reshape_batch_axes(x, number_samples, number_datapoints) for key, x in value.items()}
+    return value
+
+
+class DeferredNormalSample(object):
+    """
+    Sample of a Normal variable that is not drawn. When it is the left matrix of batch_matmul, the product is directly
+    sampled from the Normal distribution that it induces (local reparameterization).
+
+    Parameters
+    ----------
+    mu : chainer.Variable
+    sigma : chainer.Variable
+    number_samples : int
+    """
+    def __init__(self, mu, sigma, number_samples):
+        self.mu, self.sigma = F.broadcast(mu, sigma)
+        self.number_samples = number_samples
+
+    @property
+    def shape(self):
+        return (self.number_samples,) + self.mu.shape[1:]
+
+
+def batch_apply(fn, args, kwargs={}):
+    """
+    It applies a function that expects the flat (samples*datapoints, ...) layout to arguments with the
+    (samples, datapoints, ...) layout. Only the chainer variables among the arguments are broadcasted and flattened and
+    the result is reshaped back to the (samples, datapoints, ...) layout. The chainer variables inside tuple and list
+    arguments are also flattened.
+
+    Args:
+        fn: Callable.
+
+        args: Iterable. Positional arguments of fn.
+
+        kwargs: Dictionary(String: Object). Keyword arguments of fn.
+
+    Returns:
+        The output of fn.
+    """
+    names = list(kwargs.keys())
+    arguments = list(args) + [kwargs[name] for name in names]
+    is_sequence = [isinstance(x, (tuple, list)) for x in arguments]
+    values = [value for x, sequence in zip(arguments, is_sequence) for value in (x if sequence else (x,))]
+    if any(isinstance(x, DeferredNormalSample) for x in values):
+        raise TypeError("A locally reparameterized variable can only be the left argument of BF.matmul")
+    values = broadcast_batch_axes(*values)
+    batch_shapes = [x.shape[:2] for x in values if isinstance(x, chainer.Variable)]
+    if not batch_shapes:
+        return fn(*args, **kwargs)
+    number_samples, number_datapoints = batch_shapes[0]
+    values = [F.reshape(x, shape=(number_samples*number_datapoints,) + x.shape[2:])
+              if isinstance(x, chainer.Variable) else x
+              for x in values]
+    flat_arguments = []
+    position = 0
+    for x, sequence in zip(arguments, is_sequence):
+        if sequence:
+            flat_arguments.append(type(x)(values[position:position + len(x)]))
+            position += len(x)
+        else:
+            flat_arguments.append(values[position])
+            position += 1
+    number_args = len(args)
+    output = fn(*flat_arguments[:number_args], **dict(zip(names, flat_arguments[number_args:])))
+    return reshape_batch_axes(output, number_samples, number_datapoints)
+
+
+def batch_matmul(a, b, **kwargs):
+    """
+    It multiplies matrices with the (samples, datapoints, rows, columns) layout. When the left matrix has no datapoint
+    axis, as the weights of a layer, the product is computed with one matrix multiplication for all the datapoints
+    instead of one small multiplication for every sample and datapoint. When the right matrix has no sample axis either,
+    as the input data, all the samples are computed with a single matrix multiplication.
+
+    When the left matrix is a DeferredNormalSample, the means and the variances of the product are computed from the
+    parameters of the left matrix and the product is sampled from the resulting Normal distribution. A small constant
+    is added to the variances, so that the gradient of the standard deviation is finite when a variance is zero (e.g.
+    for inputs that are zero).
+
+    Args:
+        a: chainer.Variable or DeferredNormalSample. Left matrix.
+
+        b: chainer.Variable. Right matrix.
+
+    Returns:
+        chainer.Variable.
+    """
+    if isinstance(a, DeferredNormalSample):
+        mean = batch_matmul(a.mu, b, **kwargs)
+        variance = batch_matmul(a.sigma**2, b**2, **kwargs)
+        shape = (max(a.number_samples, mean.shape[0]),) + mean.shape[1:]
+        noise = get_random_state().normal(0, 1, size=shape).astype(mean.dtype)
+        return F.broadcast_to(mean, shape) + F.broadcast_to(F.sqrt(variance + LOCAL_REPARAMETERIZATION_EPS), shape)*noise
+    if kwargs or not all(isinstance(x, chainer.Variable) and x.ndim == 4 for x in (a, b)) or a.shape[1] != 1:
+        return batch_apply(F.matmul, [a, b], kwargs)
+    number_samples, _, number_rows, inner_size = a.shape
+    b_samples, number_datapoints, _, number_columns = b.shape
+    if b_samples == 1:
+        b_matrix = F.reshape(F.transpose(b[0], axes=(1, 0, 2)), (inner_size, number_datapoints*number_columns))
+        output = F.matmul(F.reshape(a, (number_samples*number_rows, inner_size)), b_matrix)
+    elif b_samples == number_samples:
+        b_matrix = F.reshape(F.transpose(b, axes=(0, 2, 1, 3)),
+                             (number_samples, inner_size, number_datapoints*number_columns))
+        output = F.matmul(F.reshape(a, (number_samples, number_rows, inner_size)), b_matrix)
+    else:
+        return batch_apply(F.matmul, [a, b])
+    output = F.reshape(output, (number_samples, number_rows, number_datapoints, number_columns))
+    return F.transpose(output, axes=(0, 2, 1, 3))
+
+
 def broadcast_and_squeeze(*args):
     if all([np.prod(val.shape[2:]) == 1 for val in args]):
         args = [F.reshape(val, shape=val.shape[:2] + tuple([1, 1])) for val in args] #TODO: Work in progress
@@ -89,6 +315,28 @@ def get_diagonal(tensor):
     return F.reshape(subdiagonal, shape=(dim1, dim2, dim_matrix))
 
 
+def get_one_hot(indices, number_classes, axis=2):
+    """
+    It returns the int32 one-hot encoding of an array of class indices. The indices array has to have size one along the
+    class axis.
+    """
+    classes_shape = [1] * indices.ndim
+    classes_shape[axis] = number_classes
+    return (indices == np.reshape(np.arange(number_classes), newshape=classes_shape)).astype("int32")
+
+
+def sample_categorical_indices(p_values, axis=2):
+    """
+    It returns one class index for every probability vector along the given axis using the inverse CDF method. The
+    probabilities do not need to be normalized.
+    """
+    cumulative_p = np.cumsum(p_values, axis=axis)
+    total_p = np.take(cumulative_p, [-1], axis=axis)
+    uniform_sample = total_p * get_random_state().uniform(0, 1, size=total_p.shape)
+    indices = np.sum(cumulative_p <= uniform_sample, axis=axis, keepdims=True)
+    return np.minimum(indices, p_values.shape[axis] - 1)
+
+
 def coerce_to_dtype(data, is_observed=False):
     """Summary"""
     dtype = type(data)
@@ -105,6 +353,8 @@ def coerce_to_dtype(data, is_observed=False):
             result = chainer.Variable(data.astype("int32"))
         else:
             result = chainer.Variable(data)
+    elif isinstance(data, Dataset):
+        return data
     elif issubclass(dtype, abc.Iterable):
         result = data  # TODO: This is for allowing discrete data, temporary?
         return result #TODO: This needs some clean up
@@ -136,11 +386,21 @@ def coerce_to_dtype(data, is_observed=False):
 
 
 def tile_parameter(value, number_samples):
+    """
+    It expands the sample axis of a value to number_samples. The result is a broadcasted view of the value, so the
+    value is not copied; the copies are only materialized by the operations that need them.
+    """
     value_shape = value.shape
-    reps = tuple([number_samples] + [1] * len(value_shape[1:]))
-    return F.tile(value, reps=reps)
+    if value_shape[0] == number_samples:
+        return value
+    return F.broadcast_to(value, shape=(number_samples,) + value_shape[1:])
 
 
-def reformat_sampler_input(sample_input, number_samples):
-    return {var: tile_parameter(coerce_to_dtype(value, is_observed=var.is_observed), number_samples=number_samples)
+def reformat_sampler_input(sample_input, number_samples, is_observed=None):
+    """
+    It formats the input values of a sampler. The values of the observed variables have a datapoint axis. If
+    is_observed is given, it overrides the flag of every variable.
+    """
+    return {var: tile_parameter(coerce_to_dtype(value, is_observed=var.is_observed if is_observed is None
+                                                else is_observed), number_samples=number_samples)
             for var, value in sample_input.items()}
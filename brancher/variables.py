@@ -7,37 +7,125 @@ from abc import ABC, abstractmethod
 import operator
 import numbers
 import collections
+import itertools
+import weakref
 
 import chainer
 import chainer.links as L
 import chainer.functions as F
 import numpy as np
 
-from brancher.utilities import join_dicts_list, join_sets_list
-from brancher.utilities import flatten_list
-from brancher.utilities import partial_broadcast
+from brancher.utilities import broadcast_add
 from brancher.utilities import coerce_to_dtype
 from brancher.utilities import broadcast_parent_values
+from brancher.utilities import broadcast_batch_axes
+from brancher.utilities import DeferredNormalSample
 from brancher.utilities import split_dict
 from brancher.utilities import reformat_sampler_input
 from brancher.utilities import tile_parameter
+from brancher.utilities import backprop_mode
+from brancher.utilities import topological_sort
+
+from brancher.distributions import NormalDistribution
+
+from brancher.expressions import ExpressionEvaluator
+from brancher.expressions import arithmetic_operations, getitem_operation, shape_operation, tuple_operation
+from brancher.expressions import constant_node, operation_node, variable_node
 
 from brancher.pandas_interface import reformat_sample_to_pandas
 from brancher.pandas_interface import reformat_model_summary
 from brancher.pandas_interface import pandas_frame2dict
 from brancher.pandas_interface import pandas_frame2value
 
+_creation_counter = itertools.count()
+
+
+def sort_variables(variables):
+    """
+    It returns the list of variables in the order in which they were created. The order is kept when the variables
+    are pickled, so the graphs that are traversed in this order are sampled in the same order after unpickling them.
+    """
+    return sorted(variables, key=operator.attrgetter("_creation_order"))
+
+
 class BrancherClass(ABC):
     """
     BrancherClass is the abstract superclass of all Brancher variables and models.
     """
-    @abstractmethod
+    __slots__ = ("_graph_index",)
+    _transient_attributes = ("_graph_index",)
+
+    def __getstate__(self):
+        """
+        It returns the attributes of the object for pickling. The cached indices and plans are not stored, since they
+        are rebuilt when they are first needed.
+        """
+        state = dict(getattr(self, "__dict__", {}))
+        for cls in type(self).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                if name not in ("__dict__", "__weakref__") and hasattr(self, name):
+                    state[name] = getattr(self, name)
+        for name in self._transient_attributes:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        for name in self._transient_attributes:
+            object.__setattr__(self, name, None)
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
     def _flatten(self):
         """
-        Abstract method. It returs a list of all the variables contained in the model.
+        Method. It returs a list of all the variables contained in the model in topological order.
+        """
+        return list(self._get_graph_index().topological_order)
+
+    @abstractmethod
+    def _get_graph_roots(self):
+        """
+        Abstract method. It returns the variables from which all the variables contained in the object can be reached.
         """
         pass
 
+    def _get_graph_index(self):
+        """
+        It returns the structural index of the variables contained in the object. The index is cached and only rebuilt
+        after a change in the structure or in the observation state of one of its variables.
+        """
+        graph_index = getattr(self, "_graph_index", None)
+        if graph_index is None or not graph_index.is_valid:
+            graph_index = GraphIndex(self._get_graph_roots())
+            self._graph_index = graph_index
+        return graph_index
+
+    def _get_compiled_plan(self, key, compile_plan):
+        """
+        It returns the cached execution plan with the given key, compiling it if needed. The plans are stored in the
+        graph index, so they are compiled again after any change in the structure of the graph.
+        """
+        graph_index = self._get_graph_index()
+        if key not in graph_index.compiled_plans:
+            plan = compile_plan()
+            graph_index.watch(getattr(plan, "variables", ()))
+            graph_index.compiled_plans[key] = plan
+        return graph_index.compiled_plans[key]
+
+    def _get_sampling_schedule(self, observed, input_values):
+        """
+        It returns the cached sampling schedule of the object for the given observation mode and input variables.
+        """
+        return self._get_compiled_plan(("sampling", observed, frozenset(input_values)),
+                                       lambda: SamplingSchedule(self._get_graph_roots(), observed, input_values))
+
+    def _get_log_probability_plan(self, excluded_variables=frozenset(), scale_minibatches=False):
+        """
+        It returns the cached log probability plan of the object.
+        """
+        return self._get_compiled_plan(("log_probability", excluded_variables, scale_minibatches),
+                                       lambda: LogProbabilityPlan(self._get_graph_roots(), excluded_variables,
+                                                                  scale_minibatches))
+
     def flatten(self):
         return set(self._flatten())
 
@@ -52,11 +140,67 @@ class BrancherClass(ABC):
             brancher.Variable.
 
         """
-        flat_list = self._flatten()
+        return self._get_graph_index().get_variable(var_name)
+
+
+class GraphIndex(object):
+    """
+    Structural index of the variables reachable from a set of root variables. It stores the topological order, the
+    name lookup table and the children adjacency of the graph, and it computes the ancestor sets lazily. The index is
+    registered in its variables and it is invalidated when the structure or the observation state of any of them
+    changes, so the changes in other graphs do not affect it.
+
+    Parameters
+    ----------
+    roots : iterable of brancher variables
+        Summary
+    """
+    def __init__(self, roots):
+        self.is_valid = True
+        self.topological_order = topological_sort(sort_variables(roots), lambda var: sort_variables(var.parents))
+        self.names = {var.name: var for var in self.topological_order}
+        self.children = {var: [] for var in self.topological_order}
+        for var in self.topological_order:
+            for parent in var.parents:
+                self.children[parent].append(var)
+        self.is_observed = all(var.is_observed for var in self.topological_order)
+        self.compiled_plans = {}
+        self._ancestors = {}
+        self.watch(self.topological_order)
+
+    def watch(self, variables):
+        """
+        It registers the index in the variables, so that it is invalidated when any of them changes.
+        """
+        for var in variables:
+            graph_indices = getattr(var, "_graph_indices", None)
+            if graph_indices is None:
+                graph_indices = weakref.WeakSet()
+                var._graph_indices = graph_indices
+            graph_indices.add(self)
+
+    def get_variable(self, var_name):
         try:
-            return {var.name: var for var in flat_list}[var_name]
-        except ValueError:
-            raise ValueError("The variable {} is not present in the model".format(var_name))
+            return self.names[var_name]
+        except KeyError:
+            raise KeyError("The variable {} is not present in the model".format(var_name))
+
+    def get_ancestors(self, var):
+        """
+        It returns the set of ancestors of a variable of the graph.
+        """
+        if var not in self._ancestors:
+            for node in topological_sort([var], lambda v: v.parents):
+                if node not in self._ancestors:
+                    self._ancestors[node] = frozenset(ancestor for parent in node.parents
+                                                      for ancestor in self._ancestors[parent].union([parent]))
+        return self._ancestors[var]
+
+    def get_descendants(self, var):
+        """
+        It returns the set of descendants of a variable of the graph.
+        """
+        return set(topological_sort(self.children[var], lambda v: self.children[v]))
 
 
 class Variable(BrancherClass):
@@ -64,24 +208,45 @@ class Variable(BrancherClass):
     Variable is the abstract superclass of deterministic and random variables. Variables are the building blocks of
     all probabilistic models in Brancher.
     """
+    __slots__ = ("name", "_parents", "_type", "_observed", "_current_value", "_graph_indices", "_creation_order")
+    _transient_attributes = ("_graph_index", "_graph_indices")
+
+    def __new__(cls, *args, **kwargs):
+        var = super().__new__(cls)
+        var._creation_order = next(_creation_counter)
+        return var
+
     @abstractmethod
-    def calculate_log_probability(self, values, reevaluate):
+    def _calculate_log_probability_term(self, values, memo=None):
         """
-        Abstract method. It returns the log probability of the values given the model.
+        Abstract method. It returns the log probability of the value of the variable given the values of its parents.
+        The log probability of the parents is not included.
+
+        Args:
+            values: Dictionary(brancher.Variable: chainer.Variable). Same as in calculate_log_probability.
+
+            memo: Dictionary. Values of the expression nodes already computed in the same log probability pass.
+
+        Returns:
+            chainer.Variable. the log probability of the value of the variable.
+
+        """
+        pass
+
+    def calculate_log_probability(self, values):
+        """
+        Method. It returns the log probability of the values given the model formed by the variable and its ancestors.
 
         Args:
             values: Dictionary(brancher.Variable: chainer.Variable). A dictionary having the brancher.variables of the
             model as keys and chainer.Variables as values. This dictionary has to provide values for all variables of
             the model except for the deterministic variables.
 
-            reevaluate: Bool. If false it returns the output of the latest call. It avoid unnecessary computations when
-            multiple children variables ask for the log probability of the same paternt variable.
-
         Returns:
             chainer.Variable. the log probability of the input values given the model.
 
         """
-        pass
+        return self._get_log_probability_plan().evaluate(values)
 
     @abstractmethod
     def _get_sample(self, number_samples, resample, observed, input_values):
@@ -112,20 +277,72 @@ class Variable(BrancherClass):
         """
         pass
 
-    def get_sample(self, number_samples, input_values={}):
-        reformatted_input_values = reformat_sampler_input(pandas_frame2dict(input_values),
-                                                          number_samples=number_samples)
-        raw_sample = {self: self._get_sample(number_samples, resample=False,
-                                             observed=self.is_observed, input_values=reformatted_input_values)[self]}
+    @abstractmethod
+    def _get_sampling_parents(self, observed, input_values):
+        """
+        Abstract method. It returns the variables that need to be sampled before this variable can be sampled.
+
+        Args:
+            observed: Bool. Same as in _get_sample.
+
+            input_values: Dictionary(brancher.Variable, chainer.Variable). Same as in _get_sample.
+
+        Returns:
+            Tuple of brancher.Variable.
+        """
+        pass
+
+    @abstractmethod
+    def _sample_from_parents(self, parents_values, number_samples, observed, input_values, memo=None):
+        """
+        Abstract method. It returns a sample of the variable given the samples of the variables returned by
+        _get_sampling_parents. It is the single step of a sampling schedule.
+
+        Args:
+            parents_values: Dictionary(brancher.Variable: chainer.Variable). Samples of the sampling parents.
+
+            number_samples: Int.
+
+            observed: Bool. Same as in _get_sample.
+
+            input_values: Dictionary(brancher.Variable, chainer.Variable). Same as in _get_sample.
+
+            memo: Dictionary. Values of the expression nodes already computed in the same sampling pass.
+
+        Returns:
+            chainer.Variable.
+        """
+        pass
+
+    def get_sample(self, number_samples, input_values={}, backprop=None):
+        """
+        Method. It returns a pandas DataFrame with samples of the variable.
+
+        Args:
+            number_samples: Int.
+
+            input_values: Dictionary(brancher.Variable: chainer.Variable) or pandas DataFrame.
+
+            backprop: Bool. If False, the sample is drawn without building the computational graph and if True the graph
+            is built. If None, the enable_backprop configuration of the caller is used, so the sample is also drawn
+            without the graph inside chainer.no_backprop_mode().
+
+        Returns:
+            pandas.DataFrame.
+        """
+        with backprop_mode(backprop):
+            reformatted_input_values = reformat_sampler_input(pandas_frame2dict(input_values),
+                                                              number_samples=number_samples)
+            raw_sample = {self: self._get_sample(number_samples, resample=False,
+                                                 observed=self.is_observed, input_values=reformatted_input_values)[self]}
         sample = reformat_sample_to_pandas(raw_sample, number_samples)
         self.reset()
         return sample
 
     @abstractmethod
-    def reset(self):
+    def _reset_state(self):
         """
-        Abstract method. It recursively reset the self._evalueted and self._current_value attributes of the variable and
-        all downstream variables. It is used after sampling and evaluating the log probability of a model.
+        Abstract method. It resets the self.samples and self._current_value attributes of the variable.
 
         Args: None.
 
@@ -133,6 +350,18 @@ class Variable(BrancherClass):
         """
         pass
 
+    def reset(self):
+        """
+        Method. It resets the self.samples and self._current_value attributes of the variable and all its ancestors. It
+        is used after sampling and evaluating the log probability of a model.
+
+        Args: None.
+
+        Returns: None.
+        """
+        for var in self._get_graph_index().topological_order:
+            var._reset_state()
+
     @property
     @abstractmethod
     def is_observed(self):
@@ -155,12 +384,35 @@ class Variable(BrancherClass):
         """
         return self.name
 
+    @property
+    def parents(self):
+        return self._parents
+
+    @parents.setter
+    def parents(self, parents):
+        self._parents = parents
+        self._invalidate_graph_indices()
+
+    def _invalidate_graph_indices(self):
+        """
+        It invalidates the structural indices, and the plans compiled from them, of the graphs that contain the
+        variable. It has to be called after every change in the structure or in the observation state of the variable.
+        """
+        graph_indices = getattr(self, "_graph_indices", None)
+        if graph_indices:
+            for graph_index in list(graph_indices):
+                graph_index.is_valid = False
+            graph_indices.clear()
+
+    def _get_graph_roots(self):
+        return [self]
+
     def _apply_operator(self, other, op):
         """
         Method. It is used for using operations between variables symbolically. It always returns a partialLink object
-        that define a mathematical operation between variables. The vars attribute of the link is the set of variables
-        that are used in the operation. The fn attribute is a lambda that specify the operation as a functions between the
-        values of the variables in vars and a numeric output. This is required for defining the forward pass of the model.
+        that define a mathematical operation between variables. The node attribute of the link is the root of the
+        expression graph of the operation, whose leaves are the variables and the constants that are used in the
+        operation. This is required for defining the forward pass of the model.
 
         Args:
             other: PartialLink, RandomVariable, numeric or np.array.
@@ -169,23 +421,7 @@ class Variable(BrancherClass):
 
         Returns: PartialLink
         """
-        if isinstance(other, PartialLink):
-            vars = other.vars
-            vars.add(self)
-            fn = lambda values: op(values[self], other.fn(values))
-            links = other.links
-        elif isinstance(other, Variable):
-            vars = {self, other}
-            fn = lambda values: op(values[self], values[other])
-            links = set()
-        elif isinstance(other, (numbers.Number, np.ndarray)):
-            vars = {self}
-            fn = lambda values: op(values[self], other)
-            links = set()
-        else:
-            raise TypeError('') #TODO
-
-        return PartialLink(vars=vars, fn=fn, links=links)
+        return var2link(self)._apply_operator(other, op)
 
     def __add__(self, other):
         return self._apply_operator(other, operator.add)
@@ -218,20 +454,10 @@ class Variable(BrancherClass):
         raise NotImplementedError
 
     def __getitem__(self, key):
-        if isinstance(key, collections.Iterable):
-            variable_slice = (slice(None, None, None), *key)
-        else:
-            variable_slice = (slice(None, None, None), key)
-        vars = {self}
-        fn = lambda values: values[self][variable_slice]
-        links = set()
-        return PartialLink(vars=vars, fn=fn, links=links)
+        return var2link(self)[key]
 
     def shape(self):
-        vars = {self}
-        fn = lambda values: values[self].shape
-        links = set()
-        return PartialLink(vars=vars, fn=fn, links=links)
+        return var2link(self).shape()
 
 
 class DeterministicVariable(Variable):
@@ -250,6 +476,8 @@ class DeterministicVariable(Variable):
     learnable : Bool. This boolean value specify if the value of the DeterministicVariable can be updated during treaning.
 
     """
+    __slots__ = ("learnable", "link")
+
     def __init__(self, data, name, learnable=False, is_observed=False):
         self._current_value = coerce_to_dtype(data, is_observed)
         self.name = name
@@ -260,21 +488,17 @@ class DeterministicVariable(Variable):
         if learnable:
             self.link = L.Bias(axis=1, shape=self._current_value.shape[1:])
 
-    def calculate_log_probability(self, values, reevaluate=True):
+    def _calculate_log_probability_term(self, values, memo=None):
         """
-        Method. It returns the log probability of the values given the model. This value is always 0 since the probability
+        Method. It returns the log probability of the value of the variable. This value is always 0 since the probability
         of a deterministic variable having its value is always 1.
 
         Args:
             values: Dictionary(brancher.Variable: chainer.Variable). A dictionary having the brancher.variables of the
-            model as keys and chainer.Variables as values. This dictionary has to provide values for all variables of
-            the model except for the deterministic variables.
-
-            reevaluate: Bool. If false it returns the output of the latest call. It avoid unnecessary computations when
-            multiple children variables ask for the log probability of the same paternt variable.
+            model as keys and chainer.Variables as values.
 
         Returns:
-            chainer.Variable. the log probability of the input values given the model.
+            Float.
         """
         return 0.
 
@@ -293,25 +517,23 @@ class DeterministicVariable(Variable):
     def is_observed(self):
         return self._observed
 
-    def _get_sample(self, number_samples, resample=False, observed=False, input_values={}):
+    def _get_sampling_parents(self, observed, input_values):
+        return ()
+
+    def _sample_from_parents(self, parents_values, number_samples, observed, input_values, memo=None):
         if self in input_values:
-            value = input_values[self]
-        else:
-            value = self.value
+            return input_values[self]
+        return self.value
+
+    def _get_sample(self, number_samples, resample=False, observed=False, input_values={}):
+        value = self._sample_from_parents({}, number_samples, observed, input_values)
         if isinstance(value, chainer.Variable):
-            return {self: tile_parameter(value, number_samples=number_samples)}
-            #value_shape = value.shape
-            #reps = tuple([number_samples] + [1]*len(value_shape[1:]))
-            #return {self: F.tile(value, reps=reps)} #TODO: Work in progress
-        else:
-            return {self: value} #TODO: This is for allowing discrete data, temporary?
+            value = tile_parameter(value, number_samples=number_samples)
+        return {self: value} #TODO: This is for allowing discrete data, temporary?
 
-    def reset(self):
+    def _reset_state(self):
         pass
 
-    def _flatten(self):
-        return [self]
-
 
 class RandomVariable(Variable):
     """
@@ -328,6 +550,9 @@ class RandomVariable(Variable):
     link : callable
         Summary
     """
+    __slots__ = ("distribution", "_link", "samples", "_observed_value", "dataset",
+                 "has_random_dataset", "has_observed_value")
+
     def __init__(self, distribution, name, parents, link):
         self.name = name
         self.distribution = distribution
@@ -336,7 +561,6 @@ class RandomVariable(Variable):
         self._type = "Random"
         self.samples = []
 
-        self._evaluated = False
         self._observed = False
         self._observed_value = None
         self._current_value = None
@@ -350,6 +574,15 @@ class RandomVariable(Variable):
             return self._observed_value
         return self._current_value
 
+    @property
+    def link(self):
+        return self._link
+
+    @link.setter
+    def link(self, link):
+        self._link = link
+        self._invalidate_graph_indices()
+
     @value.setter
     def value(self, val):
         self._current_value = coerce_to_dtype(val)
@@ -358,7 +591,11 @@ class RandomVariable(Variable):
     def is_observed(self):
         return self._observed
 
-    def _apply_link(self, parents_values):  #TODO: This is for allowing discrete data, temporary?
+    def _apply_link(self, parents_values, memo=None):  #TODO: This is for allowing discrete data, temporary?
+        if hasattr(self.link, "evaluate_batch"):
+            output = self.link.evaluate_batch(parents_values, memo)
+            keys = list(output.keys())
+            return dict(zip(keys, broadcast_batch_axes(*[output[key] for key in keys])))
         cont_values, discrete_values = split_dict(parents_values,
                                                   condition=lambda key, val: isinstance(val, chainer.Variable))
         if cont_values:
@@ -372,43 +609,46 @@ class RandomVariable(Variable):
                   for key, val in reshaped_output.items()}
         return output
 
-    def calculate_log_probability(self, input_values, reevaluate=True):
+    def _calculate_log_probability_term(self, input_values, memo=None):
         """
-        Method. It returns the log probability of the values given the model. This value is always 0 since the probability
-        of a deterministic variable having its value is always 1.
+        Method. It returns the log probability of the value of the variable given the values of its parents.
 
         Args:
             values: Dictionary(brancher.Variable: chainer.Variable). A dictionary having the brancher.variables of the
-            model as keys and chainer.Variables as values. This dictionary has to provide values for all variables of
-            the model except for the deterministic variables.
-
-            reevaluate: Bool. If false it returns the output of the latest call. It avoid unnecessary computations when
-            multiple children variables ask for the log probability of the same paternt variable.
+            model as keys and chainer.Variables as values. This dictionary has to provide values for the variable and
+            for all its non-deterministic parents.
 
         Returns:
-            chainer.Variable. the log probability of the input values given the model.
+            chainer.Variable. the log probability of the value of the variable.
 
         """
-        if self._evaluated and not reevaluate:
-            return 0.
         if self in input_values:
             value = input_values[self]
         else:
             value = self.value
-
-        self._evaluated = True
-        deterministic_parents_values = {parent: parent.value for parent in self.parents
-                                        if (type(parent) is DeterministicVariable)}
-        parents_input_values = {parent: parent_input for parent, parent_input in input_values.items() if parent in self.parents}
-        parents_values = {**parents_input_values, **deterministic_parents_values}
-        parameters_dict = self._apply_link(parents_values)
+        parameters_dict = self._get_distribution_parameters(input_values, memo)
         log_probability = self.distribution.calculate_log_probability(value, **parameters_dict)
-        parents_log_probability = sum([parent.calculate_log_probability(input_values, reevaluate) for parent in self.parents])
         if self.is_observed:
             log_probability = F.sum(log_probability, axis=1, keepdims=True)
-        if type(log_probability) is chainer.Variable and type(parents_log_probability) is chainer.Variable:
-            log_probability, parents_log_probability = partial_broadcast(log_probability, parents_log_probability)
-        return log_probability + parents_log_probability
+        return log_probability
+
+    def _get_distribution_parameters(self, input_values, memo=None):
+        """
+        Method. It returns the parameters of the distribution of the variable given the values of its parents. The
+        deterministic parents always use their own value.
+
+        Args:
+            input_values: Dictionary(brancher.Variable: chainer.Variable). Same as in calculate_log_probability.
+
+            memo: Dictionary. Same as in _calculate_log_probability_term.
+
+        Returns:
+            Dictionary(String: chainer.Variable).
+        """
+        parents_values = {parent: parent.value if type(parent) is DeterministicVariable else input_values[parent]
+                          for parent in self.parents
+                          if type(parent) is DeterministicVariable or parent in input_values}
+        return self._apply_link(parents_values, memo)
 
     def _get_sample(self, number_samples=1, resample=True, observed=False, input_values={}):
         """
@@ -416,25 +656,48 @@ class RandomVariable(Variable):
         """
         if self.samples and not resample:
             return {self: self.samples[-1]}
-        if not observed:
-            if self in input_values:
-                return {self: input_values[self]} #TODO: This breaks the recursion if an input is provided. The future will decide if this is a feature or a bug!
-            else:
-                var_to_sample = self
-        else:
-            if self.has_observed_value:
-                return {self: self._observed_value}
-            elif self.has_random_dataset:
-                var_to_sample = self.dataset
-            else:
-                var_to_sample = self
-        parents_samples_dict = join_dicts_list([parent._get_sample(number_samples, resample, observed, input_values)
-                                                for parent in var_to_sample.parents])
-        input_dict = {parent: parents_samples_dict[parent] for parent in var_to_sample.parents}
-        parameters_dict = var_to_sample._apply_link(input_dict)
-        sample = var_to_sample.distribution.get_sample(**parameters_dict, number_samples=number_samples)
-        self.samples.append(sample)
-        return {**parents_samples_dict, self: sample}
+        joint_sample = self._get_sampling_schedule(observed, input_values).run(number_samples, input_values)
+        self.samples.append(joint_sample[self])
+        return joint_sample
+
+    def _get_subsampling_ratio(self):
+        """
+        Method. It returns the ratio between the size of a dataset and the size of the random minibatches drawn from it
+        when the variable is a random subsample of a dataset, and 1 otherwise.
+        """
+        return 1.
+
+    def _get_minibatch_scale(self):
+        """
+        Method. It returns the factor that corrects the log probability of the variable when it is observed through
+        random minibatches of a dataset, so that it is an unbiased estimate of the log probability of the full dataset.
+        """
+        if self.is_observed and self.has_random_dataset:
+            return self.dataset._get_subsampling_ratio()
+        return 1.
+
+    def _get_sampled_variable(self, observed):
+        if observed and self.has_random_dataset:
+            return self.dataset
+        return self
+
+    def _get_sampling_parents(self, observed, input_values):
+        if not observed and self in input_values:
+            return () #TODO: This breaks the recursion if an input is provided. The future will decide if this is a feature or a bug!
+        if observed and self.has_observed_value:
+            return ()
+        return tuple(self._get_sampled_variable(observed).parents)
+
+    def _sample_from_parents(self, parents_values, number_samples, observed, input_values, memo=None):
+        if not observed and self in input_values:
+            return input_values[self]
+        if observed and self.has_observed_value:
+            return self._observed_value
+        var_to_sample = self._get_sampled_variable(observed)
+        parameters_dict = {key: tile_parameter(value, number_samples)
+                           if isinstance(value, chainer.Variable) and value.shape[0] == 1 else value
+                           for key, value in var_to_sample._apply_link(parents_values, memo).items()}
+        return var_to_sample.distribution.get_sample(**parameters_dict, number_samples=number_samples)
 
     def observe(self, data, random_indices=()):
         """
@@ -448,6 +711,7 @@ class RandomVariable(Variable):
             self._observed_value = coerce_to_dtype(data, is_observed=True)
             self.has_observed_value = True
         self._observed = True
+        self._invalidate_graph_indices()
 
     def unobserve(self):
         self._observed = False
@@ -455,19 +719,151 @@ class RandomVariable(Variable):
         self.has_random_dataset = False
         self._observed_value = None
         self.dataset = None
+        self._invalidate_graph_indices()
 
-    def reset(self):
+    def _reset_state(self):
         """
         Summary
         """
         self.samples = []
-        self._evaluated = False
         self._current_value = None
-        for parent in self.parents:
-            parent.reset()
 
-    def _flatten(self):
-        return flatten_list([parent._flatten() for parent in self.parents]) + [self]
+
+class SamplingSchedule(object):
+    """
+    Compiled sampling plan of a set of variables. The variables are stored in topological order together with the
+    positions of their sampling parents, so that a joint sample can be obtained with a single flat loop that fills a
+    preallocated slot table. The independent variables are sampled in the order in which they were created. The links
+    of all the variables share a memo of expression values, so a subexpression used by several links is computed once.
+
+    Parameters
+    ----------
+    variables : iterable of brancher variables
+        Variables that have to be sampled. Their ancestors are added to the schedule.
+    observed : bool
+        Same as in Variable._get_sample.
+    input_values : dict or set of brancher variables
+        The keys of the input_values that will be passed to the schedule.
+    """
+    def __init__(self, variables, observed, input_values):
+        self.observed = observed
+        sorted_variables = topological_sort(sort_variables(variables),
+                                            lambda var: sort_variables(var._get_sampling_parents(observed,
+                                                                                                 input_values)))
+        slots = {var: index for index, var in enumerate(sorted_variables)}
+        self.steps = []
+        for var in sorted_variables:
+            parents = var._get_sampling_parents(observed, input_values)
+            self.steps.append((var, parents, tuple(slots[parent] for parent in parents)))
+        self.variables = sorted_variables + [var._get_sampled_variable(observed) for var in sorted_variables
+                                             if isinstance(var, RandomVariable)]
+
+    def __len__(self):
+        return len(self.steps)
+
+    def run(self, number_samples, input_values):
+        """
+        It returns a joint sample of all the variables in the schedule.
+
+        Args:
+            number_samples: Int.
+
+            input_values: Dictionary(brancher.Variable, chainer.Variable). It must have the same keys that were used for
+            compiling the schedule.
+
+        Returns:
+            Dictionary(brancher.Variable: chainer.Variable).
+        """
+        slot_table = [None] * len(self.steps)
+        memo = {}
+        for index, (var, parents, parent_slots) in enumerate(self.steps):
+            parents_values = {parent: slot_table[slot] for parent, slot in zip(parents, parent_slots)}
+            slot_table[index] = var._sample_from_parents(parents_values, number_samples,
+                                                         self.observed, input_values, memo)
+        return {var: tile_parameter(value, number_samples)
+                if type(var) is DeterministicVariable and isinstance(value, chainer.Variable) else value
+                for (var, _, _), value in zip(self.steps, slot_table)}
+
+
+class LogProbabilityPlan(object):
+    """
+    Compiled log probability evaluator of a set of variables. The random variables of the model are stored once and in
+    topological order, so that the log joint probability is obtained by summing the per-variable terms in a single pass.
+    As in SamplingSchedule, the links of the variables share a memo of expression values during the pass.
+
+    Parameters
+    ----------
+    variables : iterable of brancher variables
+        Variables of the model. Their ancestors are added to the plan.
+    excluded_variables : iterable of brancher variables
+        Variables whose term is left out of the sum.
+    scale_minibatches : bool
+        If True, the terms of the variables observed through random minibatches are multiplied by the ratio between the
+        size of the dataset and the size of the minibatches.
+    """
+    def __init__(self, variables, excluded_variables=(), scale_minibatches=False):
+        excluded_variables = set(excluded_variables)
+        self.variables = [var for var in topological_sort(sort_variables(variables),
+                                                          lambda var: sort_variables(var.parents))
+                          if type(var) is not DeterministicVariable and var not in excluded_variables]
+        self.scales = [var._get_minibatch_scale() if scale_minibatches else 1. for var in self.variables]
+
+    def __len__(self):
+        return len(self.variables)
+
+    def evaluate(self, values):
+        """
+        It returns the log joint probability of the values.
+
+        Args:
+            values: Dictionary(brancher.Variable: chainer.Variable). Same as in Variable.calculate_log_probability.
+
+        Returns:
+            chainer.Variable.
+        """
+        log_probability = 0.
+        memo = {}
+        for var, scale in zip(self.variables, self.scales):
+            log_probability_term = var._calculate_log_probability_term(values, memo)
+            if scale != 1.:
+                log_probability_term = scale*log_probability_term
+            log_probability = broadcast_add(log_probability_term, log_probability)
+        return log_probability
+
+
+class AnalyticDivergencePlan(object):
+    """
+    Compiled selection of the terms of the ELBO that are computed analytically. It stores the pairs (posterior variable,
+    joint variable) whose KL divergence can be computed analytically and the posterior variables whose entropy can be
+    computed analytically. The KL divergence of a pair is only used when the parents of the joint variable do not depend
+    on the posterior variable, otherwise the estimator would be biased. The posterior variables and the joint variables
+    they are mapped to are watched, so the plan is compiled again after any change in them.
+
+    Parameters
+    ----------
+    posterior_model : brancher.PosteriorModel
+    input_values : dict or set of brancher variables
+        The keys of the input_values of the ELBO. The input variables are not sampled, so they have no terms.
+    """
+    def __init__(self, posterior_model, input_values):
+        model_mapping = posterior_model.model_mapping
+        inverse_mapping = {p_var: q_var for q_var, p_var in model_mapping.items()}
+        posterior_index = posterior_model._get_graph_index()
+        self.kl_pairs = []
+        self.entropy_variables = []
+        for q_var in posterior_index.topological_order:
+            if not isinstance(q_var, RandomVariable) or q_var in input_values:
+                continue
+            p_var = model_mapping.get(q_var)
+            if (isinstance(p_var, RandomVariable) and not p_var.is_observed
+                    and q_var.distribution.has_analytic_kl(p_var.distribution)):
+                descendants = posterior_index.get_descendants(q_var)
+                if not any(inverse_mapping.get(parent) in descendants for parent in p_var.parents):
+                    self.kl_pairs.append((q_var, p_var))
+                    continue
+            if q_var.distribution.has_analytic_entropy():
+                self.entropy_variables.append(q_var)
+        self.variables = list(posterior_index.topological_order) + list(model_mapping.values())
 
 
 class ProbabilisticModel(BrancherClass):
@@ -484,12 +880,27 @@ class ProbabilisticModel(BrancherClass):
         self._set_summary()
         self.posterior_model = None
         self.observed_submodel = None
+        self.probabilistic_optimizer = None
         self.diagnostics = {}
         if not all([var.is_observed for var in self.variables]): #TODO: this is not elegant
             self.update_observed_submodel()
         else:
             self.observed_submodel = self
 
+    _transient_attributes = ("_graph_index", "probabilistic_optimizer")
+
+    def __getstate__(self):
+        # The variables are stored first and in topological order, so that every variable is pickled after its parents
+        # and pickling does not recurse along the chains of the model
+        state = {"_pickled_variables": self._flatten()}
+        state.update(super().__getstate__())
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        state.pop("_pickled_variables", None)
+        super().__setstate__(state)
+
     def __str__(self): #TODO: Work in progress
         """
         Method.
@@ -509,7 +920,7 @@ class ProbabilisticModel(BrancherClass):
 
     def _set_summary(self): #TODO: Work in progress
         feature_list = ["Distribution", "Parents", "Observed"]
-        var_list = self.flatten()
+        var_list = self._get_graph_index().topological_order
         var_names = [var.name for var in var_list]
         summary_data = [[var._type, var.parents, var.is_observed]
                          for var in var_list]
@@ -530,7 +941,7 @@ class ProbabilisticModel(BrancherClass):
 
     @property
     def is_observed(self):
-        return all([var.is_observed for var in self._flatten()])
+        return self._get_graph_index().is_observed
 
     def update_observed_submodel(self):
         """
@@ -539,36 +950,40 @@ class ProbabilisticModel(BrancherClass):
         Parameters
         ---------
         """
-        flattened_model = self._flatten()
+        flattened_model = self._get_graph_index().topological_order
         observed_variables = [var for var in flattened_model if var.is_observed]
         self.observed_submodel = ProbabilisticModel(observed_variables)
 
     def set_posterior_model(self, model):
         self.posterior_model = PosteriorModel(posterior_model=model, joint_model=self)
+        self._get_graph_index().compiled_plans.clear()
 
-    def calculate_log_probability(self, rv_values):
+    def calculate_log_probability(self, rv_values, excluded_variables=frozenset(), scale_minibatches=False):
         """
         Summary
+
+        Parameters
+        ----------
+        scale_minibatches : bool
+            If True, the log probabilities of the variables observed through random minibatches are scaled to estimate
+            the log probability of the full dataset.
         """
-        log_probability = sum([var.calculate_log_probability(rv_values, reevaluate=False) for var in self.variables])
-        self.reset()
-        return log_probability
+        return self._get_log_probability_plan(frozenset(excluded_variables), scale_minibatches).evaluate(rv_values)
 
     def _get_sample(self, number_samples, observed=False, input_values={}):
         """
         Summary
         """
-        joint_sample = join_dicts_list([var._get_sample(number_samples=number_samples, resample=False,
-                                                        observed=observed, input_values=input_values)
-                                        for var in self.variables])
+        schedule = self._get_sampling_schedule(observed, input_values)
+        joint_sample = schedule.run(number_samples, input_values)
         joint_sample.update(input_values)
-        self.reset()
         return joint_sample
 
-    def get_sample(self, number_samples, input_values={}):
-        reformatted_input_values = reformat_sampler_input(pandas_frame2dict(input_values),
-                                                                            number_samples=number_samples)
-        raw_sample = self._get_sample(number_samples, observed=False, input_values=reformatted_input_values)
+    def get_sample(self, number_samples, input_values={}, backprop=None):
+        with backprop_mode(backprop):
+            reformatted_input_values = reformat_sampler_input(pandas_frame2dict(input_values),
+                                                              number_samples=number_samples)
+            raw_sample = self._get_sample(number_samples, observed=False, input_values=reformatted_input_values)
         sample = reformat_sample_to_pandas(raw_sample, number_samples=number_samples)
         return sample
 
@@ -581,34 +996,167 @@ class ProbabilisticModel(BrancherClass):
 #        elif self.posterior_model._is_trained is False:
 #            raise AttributeError("The posterior model needs to be trained before sampling.")
 
-    def _get_posterior_sample(self, number_samples, input_values={}):
+    def _get_posterior_sample(self, number_samples, input_values={}, backprop=None):
         """
         Summary
+
+        Parameters
+        ----------
+        backprop : bool
+            If False, the sample is drawn without building the computational graph, so the returned chainer variables
+            do not retain the functions that created them. Predictive samples should use it when no gradient is taken.
+            If None, the enable_backprop configuration of the caller is used.
         """
         self.check_posterior_model()
-        posterior_sample = self.posterior_model._get_posterior_sample(number_samples=number_samples,
-                                                                      input_values=input_values)
-        sample = self._get_sample(number_samples, input_values=posterior_sample)
+        with backprop_mode(backprop):
+            posterior_sample = self.posterior_model._get_posterior_sample(number_samples=number_samples,
+                                                                          input_values=input_values)
+            sample = self._get_sample(number_samples, input_values=posterior_sample)
         return sample
 
-    def get_posterior_sample(self, number_samples, input_values={}): #TODO: Work in progress
-        reformatted_input_values = reformat_sampler_input(pandas_frame2dict(input_values),
-                                                                            number_samples=number_samples)
-        raw_sample = self._get_posterior_sample(number_samples, input_values=reformatted_input_values)
+    def get_posterior_sample(self, number_samples, input_values={}, backprop=None): #TODO: Work in progress
+        with backprop_mode(backprop):
+            reformatted_input_values = reformat_sampler_input(pandas_frame2dict(input_values),
+                                                              number_samples=number_samples)
+            raw_sample = self._get_posterior_sample(number_samples, input_values=reformatted_input_values,
+                                                    backprop=backprop)
         sample = reformat_sample_to_pandas(raw_sample, number_samples=number_samples)
         return sample
 
-    def estimate_log_model_evidence(self, number_samples, method="ELBO", input_values={}):  #TODO Work in progress
+    def predict(self, input_values, number_samples, variables=None, prediction="mean"):
+        """
+        It returns the posterior predictive distribution of the variables for many inputs at once. The inputs are
+        stacked along the datapoint axis, a single set of posterior samples is drawn and the forward model is evaluated
+        for all the inputs together, without building the computational graph.
+
+        Parameters
+        ----------
+        input_values : dict or pandas DataFrame
+            Values of the input variables. The first axis of every value indexes the inputs.
+        number_samples : int
+            Number of posterior samples.
+        variables : brancher.Variable or list of brancher.Variable
+            Predicted variables. If None, the variables of the model that are not inputs are predicted.
+        prediction : str
+            "samples" returns the predictive samples, with shape (samples, inputs, ...), "mean" returns their mean and
+            "probabilities" returns the class probabilities of categorical variables averaged over the posterior
+            samples. The last two have shape (inputs, ...). Requesting the probabilities of a variable whose
+            distribution does not have class probabilities raises a ValueError.
+
+        Returns
+        -------
+        dict
+            Dictionary(brancher.Variable: np.ndarray).
+        """
+        if prediction not in ("samples", "mean", "probabilities"):
+            raise ValueError("The prediction needs to be either \"samples\", \"mean\" or \"probabilities\"")
+        input_values = pandas_frame2dict(input_values)
+        if variables is None:
+            variables = [var for var in self.variables if var not in input_values]
+        elif isinstance(variables, Variable):
+            variables = [variables]
+        if prediction == "probabilities":
+            for var in variables:
+                if not isinstance(var, RandomVariable) or not var.distribution.has_probabilities():
+                    raise ValueError("The variable {} does not have class probabilities, only the \"samples\" and "
+                                     "\"mean\" predictions are available".format(var.name))
+        with chainer.using_config("enable_backprop", False):
+            # The first axis of every input indexes the datapoints, also when the input variable is not observed
+            reformatted_input_values = reformat_sampler_input(input_values, number_samples=number_samples,
+                                                              is_observed=True)
+            sample = self._get_posterior_sample(number_samples, input_values=reformatted_input_values, backprop=False)
+            if prediction == "probabilities":
+                predictions = {var: var.distribution.get_probabilities(**var._get_distribution_parameters(sample))
+                               for var in variables}
+            else:
+                predictions = {var: sample[var] for var in variables}
+        predictions = {var: value.data if isinstance(value, chainer.Variable) else np.array(value)
+                       for var, value in predictions.items()}
+        if prediction == "samples":
+            return predictions
+        return {var: np.mean(value, axis=0) for var, value in predictions.items()}
+
+    def _get_analytic_divergence_plan(self, input_values):
+        """
+        It returns the cached plan of the terms of the ELBO that are computed analytically.
+        """
+        return self._get_compiled_plan(("analytic divergences", frozenset(input_values)),
+                                       lambda: AnalyticDivergencePlan(self.posterior_model, input_values))
+
+    def _get_local_reparameterization_values(self, variables, kl_pairs, number_samples, input_values):
+        """
+        It returns the deferred samples of the locally reparameterized posterior variables. Their prior terms are only
+        valid when they have an analytic KL divergence, and they cannot have random parents or posterior children.
+        """
+        kl_variables = {q_var for q_var, _ in kl_pairs}
+        posterior_index = self.posterior_model._get_graph_index()
+        deferred_samples = {}
+        for q_var in variables:
+            if q_var not in kl_variables or not isinstance(q_var.distribution, NormalDistribution):
+                raise ValueError("The local reparameterization of {} requires a Normal posterior variable with an "
+                                 "analytic KL divergence from its prior (method=\"analytic ELBO\")".format(q_var.name))
+            if (posterior_index.children[q_var]
+                    or any(type(parent) is not DeterministicVariable for parent in q_var.parents)):
+                raise ValueError("The local reparameterization of {} requires a mean-field posterior variable "
+                                 "without posterior children".format(q_var.name))
+            parameters = q_var._get_distribution_parameters(input_values)
+            deferred_samples[q_var] = DeferredNormalSample(parameters["mu"], parameters["sigma"], number_samples)
+        return deferred_samples
+
+    def estimate_log_model_evidence(self, number_samples, method="ELBO", input_values={},
+                                    observed_sample=None, local_reparameterization=()):  #TODO Work in progress
+        """
+        Summary
+
+        Parameters
+        ----------
+        method : str
+            "ELBO" estimates all the terms of the evidence lower bound by Monte Carlo. "analytic ELBO" uses the analytic
+            KL divergence between posterior and prior variables (or the analytic entropy of the posterior variables) when
+            available, and only estimates the remaining terms by Monte Carlo.
+        observed_sample : dict
+            A sample of the observed submodel (e.g. a prefetched minibatch). If None, it is sampled here.
+        local_reparameterization : iterable of brancher.RandomVariable
+            Normal posterior variables used as left matrix of BF.matmul. Their value is not sampled, the products are
+            directly sampled from the Normal distribution they induce. It requires method="analytic ELBO".
+        """
         self.check_posterior_model()
-        if method is "ELBO":
-            samples = self.observed_submodel._get_sample(1, observed=True) #TODO: You need to correct for subsampling
+        if method == "ELBO" or method == "analytic ELBO":
+            if method == "analytic ELBO":
+                analytic_plan = self._get_analytic_divergence_plan(input_values)
+                kl_pairs, entropy_variables = analytic_plan.kl_pairs, analytic_plan.entropy_variables
+            else:
+                kl_pairs, entropy_variables = [], []
+            if observed_sample is None:
+                samples = self.observed_submodel._get_sample(1, observed=True)
+            else:
+                samples = dict(observed_sample)
+            if local_reparameterization:
+                posterior_input_values = dict(input_values)
+                posterior_input_values.update(self._get_local_reparameterization_values(local_reparameterization,
+                                                                                        kl_pairs, number_samples,
+                                                                                        input_values))
+            else:
+                posterior_input_values = input_values
             posterior_samples = self.posterior_model._get_sample(number_samples=number_samples,
-                                                                 observed=False, input_values=input_values)
-            posterior_log_prob = self.posterior_model.calculate_log_probability(posterior_samples)
+                                                                 observed=False, input_values=posterior_input_values)
+            analytic_q_variables = [q_var for q_var, _ in kl_pairs] + entropy_variables
+            analytic_p_variables = [p_var for _, p_var in kl_pairs]
+            posterior_log_prob = self.posterior_model.calculate_log_probability(posterior_samples,
+                                                                                excluded_variables=analytic_q_variables)
             samples.update(self.posterior_model.posterior_sample2joint_sample(posterior_samples))
-            joint_log_prob = self.calculate_log_probability(samples)
-            log_model_evidence = F.mean(joint_log_prob - posterior_log_prob) #TODO: It was sum, bug?
-            return log_model_evidence
+            joint_log_prob = self.calculate_log_probability(samples, excluded_variables=analytic_p_variables,
+                                                            scale_minibatches=True)
+            log_model_evidence = broadcast_add(joint_log_prob, -posterior_log_prob)
+            for q_var, p_var in kl_pairs:
+                q_parameters = q_var._get_distribution_parameters(posterior_samples)
+                p_parameters = p_var._get_distribution_parameters(samples)
+                kl_divergence = q_var.distribution.calculate_kl_divergence(p_var.distribution, q_parameters, p_parameters)
+                log_model_evidence = broadcast_add(log_model_evidence, -kl_divergence)
+            for q_var in entropy_variables:
+                entropy = q_var.distribution.calculate_entropy(**q_var._get_distribution_parameters(posterior_samples))
+                log_model_evidence = broadcast_add(log_model_evidence, entropy)
+            return F.mean(log_model_evidence) #TODO: It was sum, bug?
         else:
             raise NotImplementedError("The requested estimation method is currently not implemented.")
 
@@ -616,11 +1164,11 @@ class ProbabilisticModel(BrancherClass):
         """
         Summary
         """
-        for variable in self.variables:
-            variable.reset()
+        for variable in self._get_graph_index().topological_order:
+            variable._reset_state()
 
-    def _flatten(self):
-        return flatten_list([var._flatten() for var in self.variables])
+    def _get_graph_roots(self):
+        return self.variables
 
 
 class PosteriorModel(ProbabilisticModel):
@@ -641,10 +1189,12 @@ class PosteriorModel(ProbabilisticModel):
 
     def set_model_mapping(self, joint_model):
         model_mapping = {}
-        for p_var in joint_model._flatten():
-            try:
-                model_mapping.update({self.get_variable(p_var.name): p_var})
-            except KeyError:
+        posterior_names = self._get_graph_index().names
+        # When several variables of the joint model share a name, the first one in topological order is used
+        for p_var in joint_model._get_graph_index().topological_order:
+            if p_var.name in posterior_names:
+                model_mapping.setdefault(posterior_names[p_var.name], p_var)
+            else:
                 pass
                 # if p_var.is_observed or type(p_var) is DeterministicVariable:
                 #     pass
@@ -668,33 +1218,78 @@ class PosteriorModel(ProbabilisticModel):
         return sample
 
 
+def var2node(var):
+    """
+    It returns the expression node of a variable, a link or a constant. The tuples that contain variables or links are
+    converted into tuple nodes.
+    """
+    if isinstance(var, PartialLink):
+        return var.node
+    elif isinstance(var, Variable):
+        return variable_node(var)
+    elif isinstance(var, tuple) and any([isinstance(v, (Variable, PartialLink)) for v in var]):
+        return operation_node(tuple_operation, [var2node(v) for v in var])
+    return constant_node(var)
+
+
 def var2link(var):
-    if isinstance(var, Variable):
-        vars = {var}
-        fn = lambda values: values[var]
-    elif isinstance(var, (numbers.Number, np.ndarray)):
-        vars = {}
-        fn = lambda values: var
+    if isinstance(var, (Variable, numbers.Number, np.ndarray)):
+        return PartialLink(var2node(var))
     elif isinstance(var, tuple) and all([isinstance(v, (Variable, PartialLink)) for v in var]):
-        vars = join_sets_list([{v} if isinstance(v, Variable) else v.vars for v in var])
-        fn = lambda values: tuple([values[v] if isinstance(v, Variable) else v.fn(values) for v in var])
-    else:
-        return var
-    return PartialLink(vars=vars, fn=fn, links=set())
+        return PartialLink(var2node(var))
+    return var
 
 
 class PartialLink(BrancherClass): #TODO: This should become "ProbabilisticProgram?"
+    """
+    Summary
+
+    Parameters
+    ----------
+    node : brancher.expressions.ExpressionNode
+        Root of the expression graph of the link. Structurally equal subexpressions are the same node, so they are only
+        computed once per evaluation.
+    """
+    _transient_attributes = ("_graph_index", "_fn", "_batch_fn")
+
+    def __init__(self, node):
+        self.node = node
+        self._fn = None
+        self._batch_fn = None
+
+    @property
+    def vars(self):
+        return set(self.node.vars)
+
+    @property
+    def links(self):
+        return set(self.node.links)
 
-    def __init__(self, vars, fn, links):
-        self.vars = vars
-        self.fn = fn
-        self.links = links
+    @property
+    def fn(self):
+        """
+        Evaluator that maps a dictionary of values with the flat (samples*datapoints, ...) layout to the output of the
+        link.
+        """
+        if self._fn is None:
+            self._fn = ExpressionEvaluator([self.node])
+        return self._fn
+
+    @property
+    def batch_fn(self):
+        """
+        Evaluator that maps a dictionary of values with the (samples, datapoints, ...) layout to the output of the link
+        with the same layout. The sample and datapoint axes are only broadcasted inside the operations that combine
+        values, so values without a datapoint or a sample axis are not copied.
+        """
+        if self._batch_fn is None:
+            self._batch_fn = ExpressionEvaluator([self.node], batch=True)
+        return self._batch_fn
 
     def _apply_operator(self, other, op):
-        other = var2link(other)
-        return PartialLink(vars=self.vars.union(other.vars),
-                           fn=lambda values: op(self.fn(values), other.fn(values)),
-                           links=self.links.union(other.links))
+        if not isinstance(other, (PartialLink, Variable, numbers.Number, np.ndarray)):
+            raise TypeError("Unsupported operand type for a Brancher operation: {}".format(type(other).__name__))
+        return PartialLink(operation_node(arithmetic_operations[op], [self.node, var2node(other)]))
 
     def __add__(self, other):
         return self._apply_operator(other, operator.add)
@@ -731,16 +1326,13 @@ class PartialLink(BrancherClass): #TODO: This should become "ProbabilisticProgra
             variable_slice = (slice(None, None, None), *key)
         else:
             variable_slice = (slice(None, None, None), key)
-        vars = self.vars
-        fn = lambda values: self.fn(values)[variable_slice]
-        links = set()
-        return PartialLink(vars=vars, fn=fn, links=links)
+        return PartialLink(operation_node(getitem_operation, [self.node, constant_node(variable_slice)]))
 
     def shape(self):
-        vars = self.vars
-        fn = lambda values: self.fn(values).shape
-        links = set()
-        return PartialLink(vars=vars, fn=fn, links=links)
+        return PartialLink(operation_node(shape_operation, [self.node]))
 
     def _flatten(self):
-        return flatten_list([var._flatten() for var in self.vars]) + [self]
+        return super()._flatten() + [self]
+
+    def _get_graph_roots(self):
+        return list(self.vars)
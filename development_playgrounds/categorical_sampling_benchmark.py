@@ -0,0 +1,44 @@
+import timeit
+
+import numpy as np
+import chainer
+
+from brancher.distributions import CategoricalDistribution
+
+# Parameters
+number_samples = 50
+number_datapoints = 10000
+number_classes = 10
+number_repetitions = 3
+
+activations = np.random.normal(0, 1, (number_samples, number_datapoints, number_classes))
+p_values = np.exp(activations)/np.sum(np.exp(activations), axis=2, keepdims=True)
+p = chainer.Variable(p_values.astype("float32"))
+
+
+# Reference implementation (nested multinomial loop)
+def loop_sample(p):
+    p_values = p.data.astype("float64")
+    p_values = p_values/np.sum(p_values, axis=2, keepdims=True)
+    p_shape = p_values.shape
+    sample = np.swapaxes(np.array([[np.random.multinomial(1, p_values[j, k, :])
+                                    for j in range(p_shape[0])]
+                                   for k in range(p_shape[1])]), axis1=0, axis2=1)
+    return chainer.Variable(sample.astype("int32"))
+
+
+distribution = CategoricalDistribution()
+vectorized_sample = lambda p: distribution.get_sample(p, number_samples=number_samples)
+
+# Check
+loop_frequencies = np.mean(loop_sample(p).data, axis=0)
+vectorized_frequencies = np.mean(vectorized_sample(p).data, axis=0)
+print("Sample shape: {}".format(vectorized_sample(p).shape))
+print("Max frequency difference: {}".format(np.max(np.abs(loop_frequencies - vectorized_frequencies))))
+
+# Benchmark
+loop_time = min(timeit.repeat(lambda: loop_sample(p), number=1, repeat=number_repetitions))
+vectorized_time = min(timeit.repeat(lambda: vectorized_sample(p), number=1, repeat=number_repetitions))
+print("Loop sampler: {} s".format(loop_time))
+print("Vectorized sampler: {} s".format(vectorized_time))
+print("Speed-up: {}x".format(loop_time/vectorized_time))
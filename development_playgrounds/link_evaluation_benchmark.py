@@ -0,0 +1,68 @@
+import timeit
+import tracemalloc
+
+import numpy as np
+import chainer
+import chainer.functions as F
+
+from brancher.variables import DeterministicVariable
+from brancher.standard_variables import NormalVariable, CategoricalVariable
+from brancher.utilities import tile_parameter, broadcast_parent_values
+import brancher.functions as BF
+
+# Parameters (MNIST Bayesian neural network)
+number_samples = 50
+number_datapoints = 30
+number_pixels = 28*28
+number_hidden_units = 20
+number_output_classes = 10
+number_repetitions = 3
+
+# Model
+x = DeterministicVariable(np.random.normal(0, 1, (number_datapoints, number_pixels, 1)), "x", is_observed=True)
+b1 = NormalVariable(np.zeros((number_hidden_units, 1)), np.ones((number_hidden_units, 1)), "b1")
+b2 = NormalVariable(np.zeros((number_output_classes, 1)), np.ones((number_output_classes, 1)), "b2")
+weights1 = NormalVariable(np.zeros((number_hidden_units, number_pixels)),
+                          np.ones((number_hidden_units, number_pixels)), "weights1")
+weights2 = NormalVariable(np.zeros((number_output_classes, number_hidden_units)),
+                          np.ones((number_output_classes, number_hidden_units)), "weights2")
+hidden_units = BF.tanh(BF.matmul(weights1, x) + b1)
+final_activations = BF.matmul(weights2, hidden_units) + b2
+k = CategoricalVariable(softmax_p=final_activations, name="k")
+
+# Parent values
+parents_values = {var: var._get_sample(number_samples)[var] for var in [b1, b2, weights1, weights2]}
+parents_values[x] = tile_parameter(x.value, number_samples)
+
+
+# Flat layout: every parent is broadcasted to (samples*datapoints, ...) before the link
+def flat_evaluation():
+    flat_values, number_samples, number_datapoints = broadcast_parent_values(parents_values)
+    return {key: F.reshape(value, (number_samples, number_datapoints) + value.shape[1:])
+            for key, value in k.link(flat_values).items()}
+
+
+# Batch shape layout: every parent keeps its (samples, datapoints, ...) shape
+def batch_evaluation():
+    return k._apply_link(parents_values)
+
+
+def measure(evaluation):
+    tracemalloc.start()
+    with chainer.using_config("enable_backprop", True):
+        evaluation()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    time = min(timeit.repeat(evaluation, number=1, repeat=number_repetitions))
+    return peak_memory, time
+
+
+# Check
+flat_output = flat_evaluation()["z"].data
+batch_output = batch_evaluation()["z"].data
+print("Max output difference: {}".format(np.max(np.abs(flat_output - batch_output))))
+
+# Benchmark
+for name, evaluation in [("Flat", flat_evaluation), ("Batch shape", batch_evaluation)]:
+    peak_memory, time = measure(evaluation)
+    print("{} link evaluation: {} MB, {} s".format(name, peak_memory/2.**20, time))
@@ -49,21 +49,14 @@ inference.stochastic_variational_inference(model,
 
 # Test accuracy
 num_images = 500
-test_size = len(test)
-test_indices = RandomIndices(dataset_size=test_size, batch_size=1, name="test_indices", is_observed=True)
-test_images = EmpiricalVariable(np.array([np.reshape(image[0], newshape=(number_pixels, 1)) for image in test]).astype("float32"),
-                           indices=test_indices, name="x_test", is_observed=True)
-test_labels = EmpiricalVariable(np.array([image[1]*np.ones((1, 1))
-                                          for image in test]).astype("int32"), indices=test_indices, name="labels", is_observed=True)
-test_model = ProbabilisticModel([test_images, test_labels])
+test_indices = np.random.choice(len(test), size=num_images, replace=False)
+test_images = np.array([np.reshape(test[index][0], newshape=(number_pixels, 1))
+                        for index in test_indices]).astype("float32")
+test_labels = np.array([test[index][1] for index in test_indices])
 
-s = 0
-for _ in range(num_images):
-    test_sample = test_model._get_sample(1)
-    test_image, test_label = test_sample[test_images], test_sample[test_labels]
-    model_output = np.reshape(np.mean(model._get_posterior_sample(10, input_values={x: test_image})[k].data, axis=0), newshape=(10,))
-    s += 1 if int(np.argmax(model_output)) == int(test_label.data) else 0
-print("Accuracy: {} %".format(100*s/float(num_images)))
+probabilities = model.predict({x: test_images}, number_samples=10, variables=k, prediction="probabilities")[k]
+predicted_labels = np.argmax(np.reshape(probabilities, newshape=(num_images, number_output_classes)), axis=1)
+print("Accuracy: {} %".format(100*np.mean(predicted_labels == test_labels)))
 
 #weight_map = variational_model._get_sample(1)[Qweights1].data[0, 0, 0, :]
 #plt.imshow(np.reshape(weight_map, (28, 28)))
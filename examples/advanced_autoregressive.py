@@ -56,7 +56,7 @@ inference.stochastic_variational_inference(AR_model,
 loss_list = AR_model.diagnostics["loss curve"]
 
 # Statistics
-posterior_samples = AR_model._get_posterior_sample(2000)
+posterior_samples = AR_model._get_posterior_sample(2000, backprop=False)
 b_posterior_samples = posterior_samples[b].data.flatten()
 b_mean = np.mean(b_posterior_samples)
 b_sd = np.sqrt(np.var(b_posterior_samples))
@@ -46,7 +46,7 @@ loss_list = AR_model.diagnostics["loss curve"]
 
 
 # Statistics
-posterior_samples = AR_model._get_posterior_sample(2000)
+posterior_samples = AR_model._get_posterior_sample(2000, backprop=False)
 nu_posterior_samples = posterior_samples[nu].data.flatten()
 b_posterior_samples = posterior_samples[b].data.flatten()
 b_mean = np.mean(b_posterior_samples)
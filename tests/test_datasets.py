@@ -0,0 +1,92 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+
+from .context import brancher
+from brancher.datasets import MemoryMappedDataset, ShardedDataset, load_dataset
+
+
+class DatasetTestCase(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.temporary_directory = tempfile.TemporaryDirectory()
+        self.directory = self.temporary_directory.name
+        self.data = np.random.normal(0., 1., (12, 3, 2)).astype("float32")
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    def assert_rows_match(self, dataset, indices):
+        rows = dataset.get_rows(indices)
+        self.assertEqual(rows.shape, (len(indices),) + self.data.shape[1:])
+        self.assertEqual(rows.dtype, self.data.dtype)
+        np.testing.assert_array_equal(rows, self.data[indices])
+
+
+class TestMemoryMappedDataset(DatasetTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.directory, "data.npy")
+        np.save(self.path, self.data)
+
+    def test_rows_match_the_array(self):
+        for dataset in [MemoryMappedDataset(self.path), MemoryMappedDataset(np.load(self.path, mmap_mode="r"))]:
+            self.assertEqual(len(dataset), len(self.data))
+            self.assert_rows_match(dataset, [5, 0, 11, 5, 3])
+
+    def test_load_dataset(self):
+        self.assertIsInstance(load_dataset(self.path), MemoryMappedDataset)
+        self.assertIsInstance(load_dataset(np.load(self.path, mmap_mode="r")), MemoryMappedDataset)
+        self.assertIs(load_dataset(self.data), self.data)
+
+    def test_pickled_as_its_path(self):
+        dataset = MemoryMappedDataset(self.path)
+        pickled_dataset = pickle.dumps(dataset)
+        self.assertLess(len(pickled_dataset), self.data.nbytes)
+        unpickled_dataset = pickle.loads(pickled_dataset)
+        self.assertEqual(unpickled_dataset.path, self.path)
+        self.assert_rows_match(unpickled_dataset, [7, 2, 9])
+
+
+class TestShardedDataset(DatasetTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.shard_sizes = [3, 4, 5]
+        offsets = np.cumsum([0] + self.shard_sizes)
+        for shard_index, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+            np.save(os.path.join(self.directory, "shard_{}.npy".format(shard_index)), self.data[start:end])
+
+    def test_rows_match_the_array(self):
+        dataset = ShardedDataset(self.directory)
+        self.assertEqual(len(dataset), len(self.data))
+        self.assert_rows_match(dataset, [11, 0, 4, 8, 4])
+
+    def test_shard_boundaries(self):
+        dataset = ShardedDataset(self.directory)
+        self.assert_rows_match(dataset, [2, 3, 6, 7, 0, 11])
+        self.assert_rows_match(dataset, list(range(1, 10)))
+
+    def test_load_dataset(self):
+        self.assertIsInstance(load_dataset(self.directory), ShardedDataset)
+
+    def test_pickled_as_its_path(self):
+        pickled_dataset = pickle.dumps(ShardedDataset(self.directory))
+        self.assertLess(len(pickled_dataset), self.data.nbytes)
+        unpickled_dataset = pickle.loads(pickled_dataset)
+        self.assertEqual(unpickled_dataset.directory, self.directory)
+        self.assert_rows_match(unpickled_dataset, [2, 3, 10])
+
+    def test_shards_with_different_rows_are_rejected(self):
+        np.save(os.path.join(self.directory, "shard_3.npy"), np.zeros((2, 4), dtype="float32"))
+        with self.assertRaises(ValueError):
+            ShardedDataset(self.directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import unittest
+
+import chainer
+import chainer.functions as F
+import numpy as np
+
+from .context import brancher
+from brancher.distributions import RandomIndicesDistribution, NormalDistribution
+from brancher.distributions import CategoricalDistribution, SoftmaxCategoricalDistribution
+
+
+class TestRandomIndicesDistribution(unittest.TestCase):
+
+    def draw_indices(self, distribution, number_batches):
+        return [distribution.get_sample(None, None, 1) for _ in range(number_batches)]
+
+    def test_full_epochs_return_every_index_once_per_epoch(self):
+        np.random.seed(0)
+        dataset_size, batch_size = 10, 3
+        distribution = RandomIndicesDistribution(dataset_size, batch_size, full_epochs=True)
+        batches = self.draw_indices(distribution, 20)
+        for batch in batches:
+            self.assertEqual(len(batch), batch_size)
+            self.assertEqual(len(set(batch)), batch_size)
+        indices = np.concatenate(batches)
+        for epoch in range(len(indices) // dataset_size):
+            epoch_indices = indices[epoch*dataset_size:(epoch + 1)*dataset_size]
+            self.assertEqual(sorted(epoch_indices), list(range(dataset_size)))
+
+    def test_tail_is_skipped_without_full_epochs(self):
+        np.random.seed(0)
+        dataset_size, batch_size = 10, 3
+        distribution = RandomIndicesDistribution(dataset_size, batch_size)
+        batches = self.draw_indices(distribution, 6)
+        for epoch_batches in [batches[:3], batches[3:]]:
+            indices = np.concatenate(epoch_batches)
+            self.assertEqual(len(set(indices)), len(indices))
+
+
+class TestNormalDistribution(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.distribution = NormalDistribution()
+        self.parameters = {"mu": chainer.Variable(np.array([[[0.5, -1.]]], dtype="float32")),
+                           "sigma": chainer.Variable(np.array([[[0.7, 1.5]]], dtype="float32"))}
+        self.other_parameters = {"mu": chainer.Variable(np.array([[[0., 0.3]]], dtype="float32")),
+                                 "sigma": chainer.Variable(np.array([[[1., 0.8]]], dtype="float32"))}
+
+    def get_log_probability(self, x, parameters):
+        return self.distribution.calculate_log_probability(x, parameters["mu"], parameters["sigma"]).array
+
+    def test_analytic_terms_match_monte_carlo_estimates(self):
+        number_samples = 200000
+        tiled_parameters = {name: F.broadcast_to(value, (number_samples,) + value.shape[1:])
+                            for name, value in self.parameters.items()}
+        x = self.distribution.get_sample(number_samples=number_samples, **tiled_parameters)
+        log_q = self.get_log_probability(x, self.parameters)
+        log_p = self.get_log_probability(x, self.other_parameters)
+        kl_divergence = self.distribution.calculate_kl_divergence(self.distribution, self.parameters,
+                                                                   self.other_parameters).array
+        entropy = self.distribution.calculate_entropy(**self.parameters).array
+        np.testing.assert_allclose(kl_divergence[0, 0], np.mean(log_q - log_p), rtol=0.02)
+        np.testing.assert_allclose(entropy[0, 0], -np.mean(log_q), rtol=0.02)
+
+
+class TestCategoricalDistribution(unittest.TestCase):
+
+    def test_sample_frequencies_match_the_probabilities(self):
+        np.random.seed(0)
+        probabilities = np.array([[0.1, 0.6], [0.3, 0.1], [0.6, 0.3]], dtype="float32")
+        number_samples = 20000
+        # The probabilities along the class axis do not need to be normalized
+        p = chainer.Variable(np.broadcast_to(2.*probabilities, (number_samples, 1, 3, 2)))
+        sample = CategoricalDistribution().get_sample(p, number_samples)
+        self.assertEqual(sample.shape, (number_samples, 1, 3, 2))
+        self.assertEqual(sample.dtype, np.int32)
+        np.testing.assert_array_equal(np.sum(sample.array, axis=2), 1)
+        np.testing.assert_allclose(np.mean(sample.array, axis=(0, 1)), probabilities, atol=0.015)
+
+
+class TestSoftmaxCategoricalDistribution(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.logits = np.array([1., -0.5, 0.2, 2.], dtype="float32")
+        self.log_p = self.logits - np.log(np.sum(np.exp(self.logits)))
+
+    def get_logits(self, shape):
+        return chainer.Variable(np.broadcast_to(np.reshape(self.logits, (1, 1, 4) + (1,)*(len(shape) - 3)), shape))
+
+    def test_sample_frequencies_match_the_softmax_probabilities(self):
+        z = self.get_logits((20000, 1, 4))
+        sample = SoftmaxCategoricalDistribution(one_hot=True).get_sample(z, 20000)
+        self.assertEqual(sample.shape, (20000, 1, 4))
+        np.testing.assert_array_equal(np.sum(sample.array, axis=2), 1)
+        np.testing.assert_allclose(np.mean(sample.array, axis=(0, 1)), np.exp(self.log_p), atol=0.015)
+
+    def assert_log_probability(self, distribution, sample, z, indices):
+        log_probability = distribution.calculate_log_probability(sample, z)
+        expected_log_probability = np.sum(np.reshape(self.log_p[indices], indices.shape[:2] + (-1,)), axis=2)
+        self.assertEqual(log_probability.shape, indices.shape[:2])
+        np.testing.assert_allclose(log_probability.array, expected_log_probability, rtol=1e-5)
+
+    def test_sample_then_log_probability(self):
+        for z_shape in [(5, 3, 4), (5, 3, 4, 1), (5, 3, 4, 2)]:
+            z = self.get_logits(z_shape)
+            index_distribution = SoftmaxCategoricalDistribution(one_hot=False)
+            index_sample = index_distribution.get_sample(z, 5)
+            self.assertEqual(index_sample.shape, (5, 3, 1) + z_shape[3:])
+            indices = index_sample.array[:, :, 0]
+            self.assert_log_probability(index_distribution, index_sample, z, indices)
+            self.assert_log_probability(index_distribution, np.moveaxis(np.eye(4)[indices], -1, 2), z, indices)
+            one_hot_distribution = SoftmaxCategoricalDistribution(one_hot=True)
+            one_hot_sample = one_hot_distribution.get_sample(z, 5)
+            self.assertEqual(one_hot_sample.shape, z_shape)
+            self.assert_log_probability(one_hot_distribution, one_hot_sample, z, np.argmax(one_hot_sample.array, axis=2))
+
+    def test_index_labels_without_data_axes(self):
+        z = self.get_logits((5, 3, 4, 1))
+        labels = np.random.randint(0, 4, (1, 3, 1)).astype("int32")
+        self.assert_log_probability(SoftmaxCategoricalDistribution(one_hot=False), labels, z,
+                                    np.broadcast_to(labels, (5, 3, 1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import operator
+import unittest
+
+import chainer
+import numpy as np
+
+from .context import brancher
+from brancher.variables import ProbabilisticModel
+from brancher.standard_variables import NormalVariable
+from brancher.expressions import (ConstantNode, OperationNode, constant_node, operation_node,
+                                  arithmetic_operations, getitem_operation)
+import brancher.functions as BF
+
+
+class TestConstantFolding(unittest.TestCase):
+
+    def test_numbers_and_arrays_are_folded(self):
+        node = operation_node(arithmetic_operations[operator.add], [constant_node(np.ones((2,))), constant_node(2.)])
+        self.assertIsInstance(node, ConstantNode)
+        np.testing.assert_array_equal(node.value, 3. * np.ones((2,)))
+        node = operation_node(getitem_operation, [constant_node(np.arange(3.)), constant_node((1,))])
+        self.assertIsInstance(node, ConstantNode)
+        self.assertEqual(node.value, 1.)
+
+    def test_chainer_parameters_are_not_folded(self):
+        parameter = chainer.Parameter(np.zeros((2,), dtype="float32"))
+        link = BF.exp(parameter)
+        self.assertIsInstance(link.node, OperationNode)
+        np.testing.assert_array_equal(link.fn({}).array, np.ones((2,)))
+        parameter.array[...] = 1.
+        np.testing.assert_allclose(link.fn({}).array, np.e * np.ones((2,)), rtol=1e-6)
+
+    def test_random_functions_are_neither_folded_nor_shared(self):
+        self.assertFalse(BF.gumbel_softmax.deterministic)
+        self.assertTrue(BF.softmax.deterministic)
+        logits = np.zeros((4, 5), dtype="float32")
+        link = BF.gumbel_softmax(logits)
+        self.assertIsInstance(link.node, OperationNode)
+        self.assertIsNot(BF.gumbel_softmax(logits).node, link.node)
+        first_sample, second_sample = link.fn({}).array, link.fn({}).array
+        self.assertFalse(np.allclose(first_sample, second_sample))
+
+
+class TestSharedSubexpressions(unittest.TestCase):
+
+    def setUp(self):
+        self.number_calls = 0
+
+        def count_calls(value):
+            self.number_calls += 1
+            return 2*value
+
+        x = NormalVariable(0., 1., "x")
+        shared_link = BF.BrancherFunction(count_calls, batch_fn=count_calls)(x)
+        y = NormalVariable(shared_link, 1., "y")
+        z = NormalVariable(shared_link + 1., 1., "z")
+        self.model = ProbabilisticModel([y, z])
+
+    def test_shared_subexpressions_are_evaluated_once_per_pass(self):
+        sample = self.model._get_sample(3)
+        self.assertEqual(self.number_calls, 1)
+        self.model.calculate_log_probability(sample)
+        self.assertEqual(self.number_calls, 2)
+        self.model._get_sample(3)
+        self.assertEqual(self.number_calls, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+
+import chainer
+import numpy as np
+
+from .context import brancher
+from brancher.variables import DeterministicVariable
+import brancher.functions as BF
+
+
+def evaluate_layouts(link, values):
+    """
+    It returns the outputs of a link evaluated with the flat (samples*datapoints, ...) layout, reshaped to the
+    (samples, datapoints, ...) layout, and with the (samples, datapoints, ...) layout.
+    """
+    flat_values = {var: chainer.Variable(np.reshape(value, (-1,) + value.shape[2:])) for var, value in values.items()}
+    number_samples, number_datapoints = next(iter(values.values())).shape[:2]
+    flat_output = link.fn(flat_values).data
+    batch_output = link.batch_fn({var: chainer.Variable(value) for var, value in values.items()}).data
+    return np.reshape(flat_output, (number_samples, number_datapoints) + flat_output.shape[1:]), batch_output
+
+
+class TestBatchLayout(unittest.TestCase):
+
+    def setUp(self):
+        self.x = DeterministicVariable(np.zeros((1, 3, 2)), "x")
+        self.values = {self.x: np.random.normal(0., 1., (4, 5, 3, 2)).astype("float32")}
+
+    def test_crelu(self):
+        flat_output, batch_output = evaluate_layouts(BF.crelu(self.x), self.values)
+        self.assertEqual(batch_output.shape, (4, 5, 6, 2))
+        np.testing.assert_allclose(flat_output, batch_output)
+
+    def test_elementwise_functions(self):
+        for name in ["exp", "sigmoid", "softplus", "tanh", "relu"]:
+            flat_output, batch_output = evaluate_layouts(getattr(BF, name)(self.x), self.values)
+            np.testing.assert_allclose(flat_output, batch_output, rtol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
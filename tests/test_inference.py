@@ -0,0 +1,168 @@
+import threading
+import unittest
+
+import chainer
+import numpy as np
+
+from .context import brancher
+from brancher.variables import ProbabilisticModel
+from brancher.standard_variables import NormalVariable, BinomialVariable, EmpiricalVariable, RandomIndices
+from brancher import inference
+from brancher.optimizers import ProbabilisticOptimizer
+from brancher.utilities import isolated_sampling
+import brancher.functions as BF
+
+
+def get_minibatch_model(dataset_size=20, minibatch_size=5, number_regressors=2):
+    input_variable = np.random.normal(0., 1., (dataset_size, number_regressors, 1))
+    output_labels = np.random.binomial(1, 0.5, (dataset_size, 1))
+    minibatch_indices = RandomIndices(dataset_size=dataset_size, batch_size=minibatch_size, name="indices",
+                                      is_observed=True)
+    x = EmpiricalVariable(input_variable, indices=minibatch_indices, name="x", is_observed=True)
+    labels = EmpiricalVariable(output_labels, indices=minibatch_indices, name="labels", is_observed=True)
+    weights = NormalVariable(np.zeros((1, number_regressors)), np.ones((1, number_regressors)), "weights")
+    k = BinomialVariable(1, logit_p=BF.matmul(weights, x), name="k")
+    model = ProbabilisticModel([k])
+    k.observe(labels)
+    Qweights = NormalVariable(np.zeros((1, number_regressors)), np.ones((1, number_regressors)), "weights",
+                              learnable=True)
+    model.set_posterior_model(ProbabilisticModel([Qweights]))
+    return model
+
+
+class TestObservedSamplePrefetcher(unittest.TestCase):
+
+    def run_inference(self, prefetch):
+        np.random.seed(0)
+        model = get_minibatch_model()
+        inference.stochastic_variational_inference(model, number_iterations=10, number_samples=5,
+                                                   optimizer=chainer.optimizers.Adam(0.05), prefetch=prefetch)
+        return model.diagnostics["loss curve"]
+
+    def test_seeded_runs_are_reproducible(self):
+        np.testing.assert_array_equal(self.run_inference(prefetch=3), self.run_inference(prefetch=3))
+
+    def test_seeded_minibatches_are_reproducible(self):
+        indices = []
+        for _ in range(2):
+            np.random.seed(0)
+            model = get_minibatch_model()
+            prefetcher = inference.ObservedSamplePrefetcher(model.observed_submodel, number_prefetched=2, seed=1)
+            index_variable = model.get_variable("indices")
+            indices.append([prefetcher.get_sample()[index_variable] for _ in range(6)])
+            prefetcher.close()
+        for first, second in zip(*indices):
+            np.testing.assert_array_equal(first, second)
+
+    def test_prefetched_minibatches_match_synchronous_sampling(self):
+        # The random indices keep their permutation, so each sequence is drawn from a new model
+        np.random.seed(0)
+        model = get_minibatch_model()
+        model.update_observed_submodel()
+        with inference.ObservedSamplePrefetcher(model.observed_submodel, number_prefetched=2, seed=1) as prefetcher:
+            prefetched_samples = [prefetcher.get_sample() for _ in range(6)]
+        np.random.seed(0)
+        model = get_minibatch_model()
+        model.update_observed_submodel()
+        with isolated_sampling(np.random.RandomState(1)):
+            samples = [model.observed_submodel._get_sample(1, observed=True) for _ in range(6)]
+        for prefetched_sample, sample in zip(prefetched_samples, samples):
+            values = {variable.name: value for variable, value in sample.items()}
+            for variable, prefetched_value in prefetched_sample.items():
+                if variable.name in ["indices", "x", "k"]:
+                    np.testing.assert_array_equal(chainer.as_array(prefetched_value),
+                                                  chainer.as_array(values[variable.name]))
+
+    def test_worker_is_stopped_when_inference_raises(self):
+        np.random.seed(0)
+        model = get_minibatch_model()
+        threads = set(threading.enumerate())
+        with self.assertRaises(NotImplementedError):
+            inference.stochastic_variational_inference(model, number_iterations=10, number_samples=5,
+                                                       optimizer=chainer.optimizers.Adam(0.05), method="unknown",
+                                                       prefetch=3)
+        self.assertEqual(set(threading.enumerate()) - threads, set())
+
+
+class TestOptimizerReuse(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.model = get_minibatch_model()
+        self.optimizer = chainer.optimizers.Adam(0.05)
+
+    def run_inference(self):
+        inference.stochastic_variational_inference(self.model, number_iterations=3, number_samples=5,
+                                                   optimizer=self.optimizer)
+        return self.model.probabilistic_optimizer
+
+    def test_optimizer_state_is_kept(self):
+        prob_optimizer = self.run_inference()
+        self.assertIs(self.run_inference(), prob_optimizer)
+        self.assertEqual(prob_optimizer.optimizer.t, 6)
+        self.assertEqual(self.optimizer.t, 0)
+
+    def test_optimizer_is_rebuilt_when_the_parameters_change(self):
+        prob_optimizer = self.run_inference()
+        Qweights = NormalVariable(np.zeros((1, 2)), np.ones((1, 2)), "weights", learnable=True)
+        self.model.set_posterior_model(ProbabilisticModel([Qweights]))
+        new_prob_optimizer = self.run_inference()
+        self.assertIsNot(new_prob_optimizer, prob_optimizer)
+        self.assertEqual(new_prob_optimizer.optimizer.t, 3)
+        self.assertTrue(all(var in new_prob_optimizer.learnable_variables
+                            for var in ProbabilisticOptimizer._find_links(Qweights)[1]))
+
+
+class TestSampleChunks(unittest.TestCase):
+
+    def run_inference(self, sample_chunk_size):
+        np.random.seed(0)
+        model = get_minibatch_model()
+        inference.stochastic_variational_inference(model, number_iterations=1, number_samples=6,
+                                                   optimizer=chainer.optimizers.SGD(0.01),
+                                                   sample_chunk_size=sample_chunk_size)
+        gradients = {var.name: var.link.b.grad.copy() for var in model.posterior_model.flatten()
+                     if getattr(var, "learnable", False)}
+        return gradients, model.diagnostics["loss curve"]
+
+    def assert_matches_unchunked_gradients(self, sample_chunk_size):
+        gradients, loss_curve = self.run_inference(None)
+        chunked_gradients, chunked_loss_curve = self.run_inference(sample_chunk_size)
+        np.testing.assert_allclose(chunked_loss_curve, loss_curve, rtol=1e-5)
+        self.assertEqual(sorted(chunked_gradients), sorted(gradients))
+        for name, gradient in gradients.items():
+            np.testing.assert_allclose(chunked_gradients[name], gradient, rtol=1e-5, atol=1e-6)
+
+    def test_divisor_chunk_size(self):
+        self.assertEqual(inference.get_sample_chunks(6, 2), [2, 2, 2])
+        self.assert_matches_unchunked_gradients(2)
+
+    def test_non_divisor_chunk_size(self):
+        # The last chunk is smaller and its loss is weighted by 2/6 instead of 4/6
+        self.assertEqual(inference.get_sample_chunks(6, 4), [4, 2])
+        self.assert_matches_unchunked_gradients(4)
+
+
+class TestLocalReparameterization(unittest.TestCase):
+
+    def estimate_elbo(self, model, observed_sample, local_reparameterization, number_estimates=10):
+        with chainer.no_backprop_mode():
+            return [float(model.estimate_log_model_evidence(number_samples=1000, method="analytic ELBO",
+                                                            observed_sample=observed_sample,
+                                                            local_reparameterization=local_reparameterization).data)
+                    for _ in range(number_estimates)]
+
+    def test_elbo_matches_ordinary_sampling(self):
+        np.random.seed(0)
+        model = get_minibatch_model()
+        model.update_observed_submodel()
+        observed_sample = model.observed_submodel._get_sample(1, observed=True)
+        Qweights = model.posterior_model.get_variable("weights")
+        estimates = self.estimate_elbo(model, observed_sample, ())
+        local_estimates = self.estimate_elbo(model, observed_sample, (Qweights,))
+        standard_error = np.sqrt((np.var(estimates) + np.var(local_estimates))/len(estimates))
+        self.assertLess(abs(np.mean(estimates) - np.mean(local_estimates)), 4*standard_error)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+
+from chainer import gradient_check
+import numpy as np
+
+from .context import brancher
+from brancher import kernels
+from brancher import distributions
+
+
+def get_inputs(x_low, x_high, x_shape, mu_shape, sigma_shape):
+    x = np.random.uniform(x_low, x_high, x_shape)
+    mu = np.random.normal(0., 1., mu_shape)
+    sigma = np.random.uniform(0.5, 1.5, sigma_shape)
+    return x, mu, sigma
+
+
+class TestLogDensityGradients(unittest.TestCase):
+    """
+    The analytic gradients of the fused log-densities are compared with finite differences for every input, both
+    when the inputs have the same shape and through the distributions, which broadcast the parameters.
+    """
+    kernel_domains = [(kernels.normal_log_density, distributions.NormalDistribution(), (-2., 2.)),
+                      (kernels.log_normal_log_density, distributions.LogNormalDistribution(), (0.5, 2.)),
+                      (kernels.logit_normal_log_density, distributions.LogitNormalDistribution(), (0.2, 0.8)),
+                      (kernels.cauchy_log_density, distributions.CauchyDistribution(), (-2., 2.))]
+
+    def setUp(self):
+        np.random.seed(0)
+
+    def test_gradients_of_the_kernels(self):
+        for kernel, _, (x_low, x_high) in self.kernel_domains:
+            inputs = get_inputs(x_low, x_high, (2, 3, 4), (2, 3, 4), (2, 3, 4))
+            grad_output = np.random.normal(0., 1., (2, 3))
+            gradient_check.check_backward(kernel, inputs, grad_output, dtype=np.float64, eps=1e-4,
+                                          atol=1e-5, rtol=1e-4)
+
+    def test_gradients_of_broadcasted_parameters(self):
+        for _, distribution, (x_low, x_high) in self.kernel_domains:
+            inputs = get_inputs(x_low, x_high, (2, 3, 4), (1, 1, 4), (2, 3, 1))
+            grad_output = np.random.normal(0., 1., (2, 3))
+            gradient_check.check_backward(distribution.calculate_log_probability, inputs, grad_output,
+                                          dtype=np.float64, eps=1e-4, atol=1e-5, rtol=1e-4)
+
+    def test_kernels_are_summed_over_the_data_dimensions(self):
+        x, mu, sigma = get_inputs(-2., 2., (2, 3, 4, 5), (2, 3, 4, 5), (2, 3, 4, 5))
+        log_density = kernels.normal_log_density(x, mu, sigma)
+        expected = np.sum(-0.5*np.log(2*np.pi*sigma**2) - 0.5*((x - mu)/sigma)**2, axis=(2, 3))
+        np.testing.assert_allclose(log_density.array, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+
+import chainer.functions as F
+import numpy as np
+
+from .context import brancher
+from brancher.variables import ProbabilisticModel
+from brancher.standard_variables import NormalVariable
+from brancher.optimizers import ProbabilisticOptimizer
+from brancher.chains import ParameterView
+
+
+class TestParameterPacking(unittest.TestCase):
+
+    def setUp(self):
+        self.a = NormalVariable(np.ones((1, 2)), np.ones((1, 2)), "a", learnable=True)
+        self.b = NormalVariable(0., 1., "b", learnable=True)
+
+    def test_views_expose_the_bias_parameter(self):
+        model = ProbabilisticModel([self.a])
+        variables = [var for var in model.flatten() if getattr(var, "learnable", False)]
+        for index, var in enumerate(variables):
+            var.link.b.array[...] = index + 1.
+        biases = [var.link.b.array.copy() for var in variables]
+        ProbabilisticOptimizer(model)
+        for var, bias in zip(variables, biases):
+            self.assertIsInstance(var.link, ParameterView)
+            self.assertEqual(var.link.b.shape, bias.shape)
+            np.testing.assert_array_equal(var.link.b.array, bias)
+
+    def test_other_buffers_are_not_modified(self):
+        first_optimizer = ProbabilisticOptimizer(ProbabilisticModel([self.a]))
+        first_links = {var: var.link for var in first_optimizer.learnable_variables}
+        optimizer = ProbabilisticOptimizer(ProbabilisticModel([self.a, self.b]))
+        for var, link in first_links.items():
+            self.assertIs(var.link, link)
+        self.assertEqual(len(optimizer.parameter_buffers), 2)
+        self.assertIs(optimizer.parameter_buffers[0], first_optimizer.parameter_buffers[0])
+        self.assertTrue(all(buffer in optimizer.link_set for buffer in optimizer.parameter_buffers))
+
+    def test_buffer_is_reused_for_a_subset(self):
+        first_optimizer = ProbabilisticOptimizer(ProbabilisticModel([self.a, self.b]))
+        links = {var: var.link for var in first_optimizer.learnable_variables}
+        optimizer = ProbabilisticOptimizer(ProbabilisticModel([self.b]))
+        self.assertEqual(optimizer.parameter_buffers, first_optimizer.parameter_buffers)
+        for var, link in links.items():
+            self.assertIs(var.link, link)
+
+    def test_views_alias_the_buffer(self):
+        model = ProbabilisticModel([self.a, self.b])
+        optimizer = ProbabilisticOptimizer(model)
+        buffer = optimizer.parameter_buffers[0]
+        optimizer.chain.cleargrads()
+        loss = -F.sum(model.calculate_log_probability(model._get_sample(4)))
+        loss.backward()
+        for var in optimizer.learnable_variables:
+            parameter = var.link.b
+            self.assertIsNone(parameter.creator)
+            self.assertIsNotNone(parameter.grad)
+            self.assertTrue(np.shares_memory(parameter.grad, buffer.values.grad))
+            self.assertTrue(np.shares_memory(parameter.array, buffer.values.array))
+        updated_var = optimizer.learnable_variables[0]
+        updated_var.link.b.array[...] = 3.
+        buffer.invalidate()
+        np.testing.assert_array_equal(updated_var.value.array, updated_var._current_value.array + 3.)
+        parameters = buffer.values.array.copy()
+        optimizer.update()
+        self.assertFalse(np.array_equal(buffer.values.array, parameters))
+        for var in optimizer.learnable_variables:
+            np.testing.assert_allclose(np.reshape(var.link.b.array, var.value.shape),
+                                       var.value.array - var._current_value.array, atol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+from unittest import mock
+
+import chainer.links as L
+import numpy as np
+
+from .context import brancher
+from brancher.variables import DeterministicVariable
+from brancher.standard_variables import NormalVariable, VarLink
+import brancher.functions as BF
+
+
+class TestVarLink(unittest.TestCase):
+
+    def evaluate_mu(self, z, values):
+        return z.link.evaluate_batch(values)["mu"].array.copy()
+
+    def test_deterministic_parameters_follow_link_updates(self):
+        x = DeterministicVariable(np.ones((1, 2)), "x")
+        linear = L.Linear(2, 1)
+        z = NormalVariable(BF.BrancherFunction(linear)(x), 1., "z")
+        values = {parent: parent._get_sample(3)[parent] for parent in z.parents}
+        mu = self.evaluate_mu(z, values)
+        linear.b.array[...] += 1.
+        np.testing.assert_allclose(self.evaluate_mu(z, values), mu + 1., rtol=1e-6)
+
+    def test_deterministic_parameters_are_memoized(self):
+        x = DeterministicVariable(np.ones((1, 2)), "x")
+        z = NormalVariable(BF.exp(x), 1., "z")
+        values = {parent: parent._get_sample(3)[parent] for parent in z.parents}
+        self.assertIs(z.link.evaluate_batch(values)["mu"], z.link.evaluate_batch(values)["mu"])
+
+    def test_evaluators_are_compiled_once(self):
+        with mock.patch.object(VarLink, "_compile", autospec=True, side_effect=VarLink._compile) as compile_link:
+            x = NormalVariable(np.zeros((1, 2)), np.ones((1, 2)), "x")
+            z = NormalVariable(BF.BrancherFunction(L.Linear(2, 1))(x), BF.exp(x), "z")
+            self.assertEqual(compile_link.call_count, 2)
+            batch_evaluator = z.link.batch_evaluator
+            values = {parent: parent._get_sample(3)[parent] for parent in z.parents}
+            for _ in range(3):
+                z.link.evaluate_batch(values)
+                z._get_sample(3)
+            self.assertEqual(compile_link.call_count, 2)
+            self.assertIs(z.link.batch_evaluator, batch_evaluator)
+
+
+if __name__ == '__main__':
+    unittest.main()
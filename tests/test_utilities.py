@@ -0,0 +1,93 @@
+import unittest
+
+import chainer
+import chainer.functions as F
+import numpy as np
+
+from .context import brancher
+from brancher.variables import DeterministicVariable
+from brancher.utilities import batch_matmul, DeferredNormalSample, tile_parameter
+
+
+def get_variable(*shape):
+    return chainer.Variable(np.random.normal(0., 1., shape).astype("float32"))
+
+
+class TestBatchMatmul(unittest.TestCase):
+
+    def assert_matches_flat_matmul(self, a, b):
+        output = batch_matmul(a, b)
+        np.testing.assert_allclose(output.array, np.matmul(a.array, b.array), rtol=1e-5, atol=1e-5)
+
+    def setUp(self):
+        np.random.seed(0)
+
+    def test_right_matrix_without_samples(self):
+        self.assert_matches_flat_matmul(get_variable(3, 1, 2, 4), get_variable(1, 5, 4, 6))
+
+    def test_right_matrix_with_samples(self):
+        self.assert_matches_flat_matmul(get_variable(3, 1, 2, 4), get_variable(3, 5, 4, 6))
+
+    def test_left_matrix_with_datapoints(self):
+        self.assert_matches_flat_matmul(get_variable(3, 5, 2, 4), get_variable(3, 5, 4, 6))
+
+    def test_left_matrix_with_fewer_samples(self):
+        self.assert_matches_flat_matmul(get_variable(1, 1, 2, 4), get_variable(3, 5, 4, 6))
+
+    def test_deferred_normal_sample(self):
+        mu, b = get_variable(1, 1, 2, 4), get_variable(1, 5, 4, 6)
+        sigma = chainer.Variable(np.full((1, 1, 2, 4), 0.5, dtype="float32"))
+        output = batch_matmul(DeferredNormalSample(mu, sigma, 20000), b)
+        self.assertEqual(output.shape, (20000, 5, 2, 6))
+        np.testing.assert_allclose(np.mean(output.array, axis=0), np.matmul(mu.array, b.array)[0], atol=0.05)
+        np.testing.assert_allclose(np.var(output.array, axis=0), np.matmul(sigma.array**2, b.array**2)[0],
+                                   rtol=0.1)
+
+    def test_deferred_normal_sample_gradients_with_zero_inputs(self):
+        mu, sigma = get_variable(1, 1, 2, 4), get_variable(1, 1, 2, 4)
+        b = chainer.Variable(np.zeros((1, 5, 4, 6), dtype="float32"))
+        output = batch_matmul(DeferredNormalSample(mu, sigma, 10), b)
+        output.grad = np.ones(output.shape, dtype="float32")
+        output.backward()
+        for variable in (mu, sigma, b):
+            self.assertTrue(np.isfinite(variable.grad).all())
+
+
+
+class TestTileParameter(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+
+    def assert_matches_tiled_value(self, get_value, parameter, number_samples):
+        weights = np.random.normal(0., 1., (number_samples,) + get_value().shape[1:]).astype("float32")
+        results = []
+        for expand in [tile_parameter, lambda x, n: F.tile(x, (n,) + (1,)*(x.ndim - 1))]:
+            value = get_value()
+            parameter.cleargrad()
+            expanded_value = expand(value, number_samples)
+            F.sum(weights*expanded_value).backward()
+            results.append((expanded_value.array.copy(), parameter.grad.copy()))
+        (broadcasted_value, gradient), (tiled_value, tiled_gradient) = results
+        self.assertEqual(broadcasted_value.shape, tiled_value.shape)
+        np.testing.assert_array_equal(broadcasted_value, tiled_value)
+        np.testing.assert_allclose(gradient, tiled_gradient, rtol=1e-6)
+
+    def test_single_sample_is_broadcasted(self):
+        x = get_variable(1, 3, 2)
+        self.assert_matches_tiled_value(lambda: x, x, number_samples=5)
+
+    def test_value_with_all_the_samples_is_unchanged(self):
+        x = get_variable(5, 3, 2)
+        self.assertIs(tile_parameter(x, 5), x)
+
+    def test_deterministic_value(self):
+        x = DeterministicVariable(np.random.normal(0., 1., (3, 2)), "x", learnable=True)
+        self.assert_matches_tiled_value(lambda: x.value, x.link.b, number_samples=4)
+        sample = x._get_sample(4)[x]
+        self.assertEqual(sample.shape, (4,) + x.value.shape[1:])
+        np.testing.assert_array_equal(sample.array, np.broadcast_to(x.value.array, sample.shape))
+
+
+if __name__ == '__main__':
+    unittest.main()
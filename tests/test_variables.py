@@ -0,0 +1,277 @@
+import pickle
+import unittest
+
+import chainer
+import chainer.links as L
+import numpy as np
+
+from .context import brancher
+from brancher.variables import ProbabilisticModel, DeterministicVariable
+from brancher.standard_variables import NormalVariable, CategoricalVariable, EmpiricalVariable, RandomIndices
+from brancher import inference
+import brancher.functions as BF
+from .test_inference import get_minibatch_model
+
+
+def get_chain_model(name):
+    a = NormalVariable(0., 1., name + "_a")
+    b = NormalVariable(a, 1., name + "_b")
+    return ProbabilisticModel([b]), a, b
+
+
+class TestGraphIndex(unittest.TestCase):
+
+    def test_unrelated_changes_keep_the_index(self):
+        model, _, _ = get_chain_model("first")
+        graph_index = model._get_graph_index()
+        schedule = model._get_sampling_schedule(observed=False, input_values={})
+        other_model, _, other_b = get_chain_model("second")
+        other_b.observe(np.zeros((1, 1)))
+        NormalVariable(other_b, 1., "second_c")
+        self.assertIs(model._get_graph_index(), graph_index)
+        self.assertIs(model._get_sampling_schedule(observed=False, input_values={}), schedule)
+
+    def test_observation_invalidates_the_index(self):
+        model, a, b = get_chain_model("first")
+        graph_index = model._get_graph_index()
+        b.observe(np.zeros((1, 1)))
+        self.assertIsNot(model._get_graph_index(), graph_index)
+
+    def test_reparenting_invalidates_the_index(self):
+        model, a, b = get_chain_model("first")
+        c = NormalVariable(0., 1., "first_c")
+        self.assertNotIn(c, model._get_graph_index().topological_order)
+        b.parents = b.parents.union({c})
+        self.assertIn(c, model._get_graph_index().topological_order)
+
+    def test_link_replacement_invalidates_the_schedule(self):
+        model, a, b = get_chain_model("first")
+        graph_index = model._get_graph_index()
+        schedule = model._get_sampling_schedule(observed=False, input_values={})
+        c = NormalVariable(10., 0.1, "first_c")
+        d = NormalVariable(c, 0.1, "first_d")
+        b.link = d.link
+        self.assertFalse(graph_index.is_valid)
+        b.parents = d.parents
+        self.assertIsNot(model._get_sampling_schedule(observed=False, input_values={}), schedule)
+        sample = model._get_sample(3)
+        self.assertIn(c, sample)
+        self.assertNotIn(a, sample)
+        np.testing.assert_allclose(sample[b].array, 10., atol=2.)
+
+    def test_ancestor_and_descendant_sets(self):
+        model, a, b = get_chain_model("first")
+        c = NormalVariable(b, 1., "first_c")
+        graph_index = ProbabilisticModel([c])._get_graph_index()
+        self.assertEqual(graph_index.get_ancestors(c), graph_index.get_ancestors(b).union({b}, c.parents))
+        self.assertEqual(graph_index.get_ancestors(b), graph_index.get_ancestors(a).union({a}, b.parents))
+        self.assertEqual(graph_index.get_ancestors(a), set(a.parents))
+        self.assertIs(graph_index.get_ancestors(c), graph_index.get_ancestors(c))
+        self.assertEqual(graph_index.get_descendants(a), {b, c})
+        self.assertEqual(graph_index.get_descendants(c), set())
+
+    def test_duplicated_names_map_to_the_first_joint_variable(self):
+        x = NormalVariable(0., 1., "duplicated")
+        y = NormalVariable(x, 1., "duplicated")
+        model = ProbabilisticModel([y])
+        Qx = NormalVariable(0., 1., "duplicated", learnable=True)
+        model.set_posterior_model(ProbabilisticModel([Qx]))
+        self.assertIs(model.posterior_model.model_mapping[Qx], x)
+
+
+class TestSamplingSchedule(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.a = NormalVariable(0., 1., "schedule_a")
+        self.b = NormalVariable(self.a, 0.01, "schedule_b")
+        self.c = NormalVariable(self.a, 0.01, "schedule_c")
+        self.model = ProbabilisticModel([self.b, self.c])
+
+    def test_shared_ancestors_are_sampled_once(self):
+        sample = self.model._get_sample(5)
+        self.assertTrue({self.a, self.b, self.c}.issubset(sample))
+        np.testing.assert_allclose(sample[self.b].array, sample[self.a].array, atol=0.1)
+        np.testing.assert_allclose(sample[self.c].array, sample[self.a].array, atol=0.1)
+
+    def test_schedule_is_cached_until_an_observation(self):
+        schedule = self.model._get_sampling_schedule(observed=False, input_values={})
+        self.assertIs(self.model._get_sampling_schedule(observed=False, input_values={}), schedule)
+        self.b.observe(np.zeros((1, 1)))
+        self.assertIsNot(self.model._get_sampling_schedule(observed=False, input_values={}), schedule)
+        np.testing.assert_array_equal(self.model._get_sample(5, observed=True)[self.b].array, 0.)
+
+
+class TestLogProbabilityPlan(unittest.TestCase):
+
+    def test_variable_log_probability_plan_is_cached(self):
+        a = NormalVariable(0., 1., "plan_a")
+        b = NormalVariable(a, 1., "plan_b")
+        values = {a: a._get_sample(2)[a], b: b._get_sample(2)[b]}
+        log_probability = b.calculate_log_probability(values)
+        plan = b._get_log_probability_plan()
+        np.testing.assert_allclose(b.calculate_log_probability(values).array, log_probability.array)
+        self.assertIs(b._get_log_probability_plan(), plan)
+        self.assertEqual(len(plan), 2)
+        b.observe(np.zeros((1, 1)))
+        self.assertIsNot(b._get_log_probability_plan(), plan)
+
+
+class TestAnalyticDivergencePlan(unittest.TestCase):
+
+    def test_posterior_changes_invalidate_the_analytic_divergences(self):
+        a = NormalVariable(0., 1., "joint_a")
+        b = NormalVariable(a, 1., "joint_b")
+        model = ProbabilisticModel([b])
+        Qa = NormalVariable(0., 1., "joint_a", learnable=True)
+        model.set_posterior_model(ProbabilisticModel([Qa]))
+        plan = model._get_analytic_divergence_plan({})
+        self.assertEqual(plan.kl_pairs, [(Qa, a)])
+        self.assertIs(model._get_analytic_divergence_plan({}), plan)
+        Qa.observe(np.zeros((1, 1)))
+        self.assertIsNot(model._get_analytic_divergence_plan({}), plan)
+
+
+class TestMinibatchScale(unittest.TestCase):
+
+    def get_log_likelihoods(self, indices):
+        np.random.seed(0)
+        x = EmpiricalVariable(np.random.normal(0., 1., (20, 1)), indices=indices, name="x", is_observed=True)
+        z = NormalVariable(0., 1., "z")
+        y = NormalVariable(z, 1., "y")
+        model = ProbabilisticModel([y])
+        y.observe(x)
+        model.update_observed_submodel()
+        sample = model.observed_submodel._get_sample(1, observed=True)
+        sample.update(z._get_sample(3))
+        log_likelihoods = [model.calculate_log_probability(sample, excluded_variables=[z], scale_minibatches=scale).array
+                           for scale in (False, True)]
+        return y, log_likelihoods
+
+    def test_subsampled_likelihood_is_scaled(self):
+        indices = RandomIndices(dataset_size=20, batch_size=5, name="indices", is_observed=True)
+        y, (log_likelihood, scaled_log_likelihood) = self.get_log_likelihoods(indices)
+        self.assertEqual(y._get_minibatch_scale(), 20/5.)
+        np.testing.assert_allclose(scaled_log_likelihood, 20/5.*log_likelihood, rtol=1e-6)
+
+    def test_likelihood_with_fixed_indices_is_not_scaled(self):
+        y, (log_likelihood, scaled_log_likelihood) = self.get_log_likelihoods(list(range(5)))
+        self.assertEqual(y._get_minibatch_scale(), 1.)
+        np.testing.assert_array_equal(scaled_log_likelihood, log_likelihood)
+
+
+class TestPredict(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        indices = RandomIndices(dataset_size=20, batch_size=5, name="indices", is_observed=True)
+        self.x = EmpiricalVariable(np.random.normal(0., 1., (20, 2, 1)), indices=indices, name="x", is_observed=True)
+        weights = NormalVariable(np.zeros((3, 2)), np.ones((3, 2)), "weights")
+        self.k = CategoricalVariable(softmax_p=BF.matmul(weights, self.x), name="k")
+        self.y = NormalVariable(BF.matmul(weights, self.x), 1., "y")
+        self.model = ProbabilisticModel([self.k, self.y])
+        self.weights_mu = np.random.normal(0., 1., (3, 2))
+        Qweights = NormalVariable(self.weights_mu, 0.01*np.ones((3, 2)), "weights", learnable=True)
+        self.model.set_posterior_model(ProbabilisticModel([Qweights]))
+        self.inputs = np.random.normal(0., 1., (7, 2, 1)).astype("float32")
+        self.activations = np.matmul(self.weights_mu, self.inputs)
+
+    def test_samples(self):
+        predictions = self.model.predict({self.x: self.inputs}, number_samples=4, variables=[self.k, self.y],
+                                         prediction="samples")
+        self.assertEqual(predictions[self.k].shape, (4, 7, 3, 1))
+        self.assertEqual(predictions[self.y].shape, (4, 7, 3, 1))
+        np.testing.assert_array_equal(np.sum(predictions[self.k], axis=2), 1)
+
+    def test_mean(self):
+        predictions = self.model.predict({self.x: self.inputs}, number_samples=2000, variables=self.y)
+        self.assertEqual(predictions[self.y].shape, (7, 3, 1))
+        np.testing.assert_allclose(predictions[self.y], self.activations, atol=0.15)
+
+    def test_probabilities(self):
+        predictions = self.model.predict({self.x: self.inputs}, number_samples=10, variables=self.k,
+                                         prediction="probabilities")
+        probabilities = np.exp(self.activations)/np.sum(np.exp(self.activations), axis=1, keepdims=True)
+        self.assertEqual(predictions[self.k].shape, (7, 3, 1))
+        np.testing.assert_allclose(predictions[self.k], probabilities, atol=0.02)
+
+    def test_probabilities_of_a_continuous_variable(self):
+        with self.assertRaisesRegex(ValueError, "y"):
+            self.model.predict({self.x: self.inputs}, number_samples=10, variables=self.y, prediction="probabilities")
+
+    def test_unobserved_input(self):
+        x = DeterministicVariable(np.zeros((2, 1)), "x")
+        weights = NormalVariable(np.zeros((3, 2)), np.ones((3, 2)), "weights")
+        y = NormalVariable(BF.matmul(weights, x), 1., "y")
+        model = ProbabilisticModel([y])
+        model.set_posterior_model(ProbabilisticModel([NormalVariable(self.weights_mu, 0.01*np.ones((3, 2)), "weights",
+                                                                     learnable=True)]))
+        predictions = model.predict({x: self.inputs}, number_samples=4, variables=y, prediction="samples")
+        self.assertEqual(predictions[y].shape, (4, 7, 3, 1))
+        np.testing.assert_allclose(np.mean(predictions[y], axis=0), self.activations, atol=1.5)
+
+
+class TestBackpropMode(unittest.TestCase):
+
+    def setUp(self):
+        model, _, self.b = get_chain_model("joint")
+        Qa = NormalVariable(0., 1., "joint_a", learnable=True)
+        model.set_posterior_model(ProbabilisticModel([Qa]))
+        self.model = model
+
+    def test_caller_configuration_is_kept(self):
+        self.assertIsNotNone(self.model._get_posterior_sample(2)[self.b].creator)
+        with chainer.no_backprop_mode():
+            self.assertIsNone(self.model._get_posterior_sample(2)[self.b].creator)
+
+    def test_explicit_configuration(self):
+        self.assertIsNone(self.model._get_posterior_sample(2, backprop=False)[self.b].creator)
+        with chainer.no_backprop_mode():
+            self.assertIsNotNone(self.model._get_posterior_sample(2, backprop=True)[self.b].creator)
+
+
+class TestPickling(unittest.TestCase):
+
+    def assert_equal_samples(self, model, unpickled_model, sampler):
+        np.random.seed(1)
+        sample = sampler(model)
+        np.random.seed(1)
+        unpickled_sample = sampler(unpickled_model)
+        values = {var.name: value for var, value in unpickled_sample.items()}
+        self.assertEqual(sorted(var.name for var in sample), sorted(values))
+        for var, value in sample.items():
+            if isinstance(value, chainer.Variable):
+                np.testing.assert_array_equal(value.array, values[var.name].array)
+            else:
+                np.testing.assert_array_equal(np.array(value), np.array(values[var.name]))
+
+    def test_trained_model_samples_are_reproduced(self):
+        np.random.seed(0)
+        model = get_minibatch_model()
+        inference.stochastic_variational_inference(model, number_iterations=3, number_samples=2)
+        unpickled_model = pickle.loads(pickle.dumps(model))
+        self.assert_equal_samples(model, unpickled_model, lambda m: m._get_posterior_sample(4))
+        self.assert_equal_samples(model, unpickled_model, lambda m: m._get_sample(4))
+
+    def test_link_parameters_are_reproduced(self):
+        np.random.seed(0)
+        x = NormalVariable(np.zeros((1, 2)), np.ones((1, 2)), "x")
+        y = NormalVariable(BF.BrancherFunction(L.Linear(2, 1))(x), 1., "y")
+        model = ProbabilisticModel([y])
+        unpickled_model = pickle.loads(pickle.dumps(model))
+        self.assert_equal_samples(model, unpickled_model, lambda m: m._get_sample(4))
+
+    def test_rebuilt_expressions_are_the_unpickled_nodes(self):
+        x = NormalVariable(np.zeros((1, 2)), np.ones((1, 2)), "x")
+        y = NormalVariable(BF.BrancherFunction(L.Linear(2, 1))(BF.exp(x)), 1., "y")
+        unpickled_model = pickle.loads(pickle.dumps(ProbabilisticModel([y])))
+        unpickled_x, unpickled_y = unpickled_model.get_variable("x"), unpickled_model.get_variable("y")
+        get_mu_node = lambda var: dict(zip(var.link.names, var.link.partial_links))["mu"].node
+        node = get_mu_node(unpickled_y)
+        linear = node.operation.fn
+        self.assertIsNot(linear, get_mu_node(y).operation.fn)
+        self.assertIs(BF.BrancherFunction(linear)(BF.exp(unpickled_x)).node, node)
+
+
+if __name__ == '__main__':
+    unittest.main()